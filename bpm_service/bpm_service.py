@@ -6,7 +6,6 @@ import time
 from caproto.server import ioc_arg_parser, run, pvproperty, PVGroup
 from caproto import AlarmStatus, AlarmSeverity
 import simulacrum
-import zmq
 from zmq.asyncio import Context
 
 #set up python logger
@@ -26,9 +25,9 @@ class BPMService(simulacrum.Service):
     def __init__(self):
         super().__init__()
         self.ctx = Context.instance()
-        #cmd socket is a synchronous socket, we don't want the asyncio context.
-        self.cmd_socket = zmq.Context().socket(zmq.REQ)
-        self.cmd_socket.connect("tcp://127.0.0.1:{}".format(os.environ.get('MODEL_PORT', 12312)))
+        self.model_client = simulacrum.ModelClient()
+        self.subscriber = simulacrum.Subscriber(ctx=self.ctx)
+        self.subscriber.subscribe(simulacrum.broadcast.ORBIT, self.on_orbit)
         bpms = self.fetch_bpm_list()
         device_names = [simulacrum.util.convert_element_to_device(bpm[0]) for bpm in bpms]
         device_name_map = zip(bpms, device_names)
@@ -62,8 +61,7 @@ class BPMService(simulacrum.Service):
         return orbit
     
     def fetch_bpm_list(self):
-        self.cmd_socket.send_pyobj({"cmd": "tao", "val": "show ele BPM*,RFB*"})
-        bpms = [row.split(None, 3)[1:3] for row in self.cmd_socket.recv_pyobj()['result'][:-1]]
+        bpms = [row.split(None, 3)[1:3] for row in self.model_client.tao_sync("show ele BPM*,RFB*")[:-1]]
         return bpms
     
     async def publish_z(self):
@@ -73,34 +71,19 @@ class BPMService(simulacrum.Service):
             if zpv in self:
                 await self[zpv].write(row['z'])
     
-    def request_orbit(self):
-        self.cmd_socket.send_pyobj({"cmd": "send_orbit"})
-        return self.cmd_socket.recv_pyobj()
+    async def request_orbit(self):
+        return await self.model_client.request({"cmd": "send_orbit"})
         
-    async def recv_orbit_array(self, flags=0, copy=False, track=False):
-        """recv a numpy array"""
-        model_broadcast_socket = self.ctx.socket(zmq.SUB)
-        model_broadcast_socket.connect('tcp://127.0.0.1:{}'.format(os.environ.get('MODEL_BROADCAST_PORT', 66666)))
-        model_broadcast_socket.setsockopt(zmq.SUBSCRIBE, b'')
-        while True:
-            L.debug("Checking for new orbit data.")
-            md = await model_broadcast_socket.recv_pyobj(flags=flags)
-            msg="Orbit data incoming: {}".format(md)
-            L.debug(msg)
-            if md.get("tag", None) == "orbit":
-                msg = await model_broadcast_socket.recv(flags=flags, copy=copy, track=track)
-                L.debug(msg)
-                buf = memoryview(msg)
-                A = np.frombuffer(buf, dtype=md['dtype'])
-                A = A.reshape(md['shape'])
-                self.orbit['x'] = A[0]
-                self.orbit['y'] = A[1]
-                self.orbit['alive'] = A[2] > 0
-                L.debug(self.orbit)
-                await self.publish_orbit()
-            else: 
-                await model_broadcast_socket.recv(flags=flags, copy=copy, track=track)
-                 
+    async def on_orbit(self, message):
+        msg="Orbit data incoming: {}".format(message.header)
+        L.debug(msg)
+        A = message.payload
+        self.orbit['x'] = A[0]
+        self.orbit['y'] = A[1]
+        self.orbit['alive'] = A[2] > 0
+        L.debug(self.orbit)
+        await self.publish_orbit()
+            
             
     async def publish_orbit(self):
         ts = time.time()
@@ -121,8 +104,8 @@ def main():
         default_prefix='',
         desc="Simulated BPM Service")
     loop.create_task(service.publish_z())
-    loop.create_task(service.recv_orbit_array())
-    loop.call_soon(service.request_orbit)
+    loop.create_task(service.subscriber.run())
+    loop.create_task(service.request_orbit())
     run(service, **run_options)
     
 if __name__ == '__main__':
@@ -4,7 +4,6 @@ import asyncio
 import numpy as np
 from caproto.server import ioc_arg_parser, run, pvproperty, PVGroup
 import simulacrum
-import zmq
 import time
 from zmq.asyncio import Context
 import pickle
@@ -38,6 +37,8 @@ class ProfMonService(simulacrum.Service):
         self.ele2dev = {}
         self.dev2ele = {}
         self.profiles = {}
+        #Devices that have had particle positions from the model's beam tracking mode.
+        self.tracked_screens = set()
         for screenProps in screens:
                 self.ele2dev[screenProps['element_name']] = screenProps['device_name']
                 self.dev2ele[screenProps['device_name']] = screenProps['element_name']
@@ -94,80 +95,48 @@ class ProfMonService(simulacrum.Service):
         self.add_pvs(screen_pvs)
         self.add_pvs(util_pvs)
         self.ctx = Context.instance()
-        #cmd socket is a synchronous socket, we don't want the asyncio context.
-        self.cmd_socket = zmq.Context().socket(zmq.REQ)
-        self.cmd_socket.connect("tcp://127.0.0.1:{}".format(os.environ.get('MODEL_PORT', 12312)))
+        self.model_client = simulacrum.ModelClient()
+        self.subscriber = simulacrum.Subscriber(ctx=self.ctx)
+        self.subscriber.subscribe(simulacrum.broadcast.PROF_DATA, self.on_profile_data)
+        #Keep the newest positions for each screen, not just the newest message.
+        self.subscriber.subscribe(simulacrum.broadcast.PART_POSITIONS, self.on_particle_positions, key=lambda message: bytes(message.extra[0]))
         
         L.info("Initialization complete.")
 
-    def request_profiles(self):
-        self.cmd_socket.send_pyobj({"cmd": "send_profiles_twiss"})
-        return self.cmd_socket.recv_pyobj()
+    async def request_profiles(self):
+        return await self.model_client.request({"cmd": "send_profiles_twiss"})
        
-    ################### 04.26 Jane added tag metadata filtering. Small possibility that last two blocks of this function may crash if data with another tag comes in and result/orbit are never assigned. Did not get a chance to test yet. 
-    async def recv_profiles(self, flags=0, copy=False, track=False):
-        model_broadcast_socket = self.ctx.socket(zmq.SUB)
-        model_broadcast_socket.connect('tcp://127.0.0.1:{}'.format(os.environ.get('MODEL_BROADCAST_PORT', 66666)))
-        model_broadcast_socket.setsockopt(zmq.SUBSCRIBE, b'')
-        while True:
-            L.debug("Checking for new profile data.")
-            md = await model_broadcast_socket.recv_pyobj(flags=flags)
-            particles = False
-            if md.get("tag", None) == "part_positions":
-                particles = True;
-                L.info("Got new particle positions")
-                screens = await model_broadcast_socket.recv_pyobj(flags=flags)
-                for screen in screens:
-                    devName = self.ele2dev[screen]
-                    if devName not in self.profiles:
-                        continue
-                    beamProps = { 'particlePos': screens[screen]}
-                    image = self.gen_beam_image(beamProps, self.profiles[devName]['props']['values'], img_type="positions")
-                    self.profiles[devName]['image'] = image.tolist()
-            elif md.get("tag", None) == "prof_data" and particles == False:
-                msg ="Profile data incoming: {}".format(md)
-                L.info(msg)
-                msg = await model_broadcast_socket.recv(flags=flags, copy=copy, track=track)
-                buf = memoryview(msg)
-                A = np.frombuffer(buf, dtype=md['dtype'])
-                result = np.rot90(A.reshape(md['shape']))
-                for i in range(result.shape[0]):
-                    orbit_x, orbit_y, beta_a, beta_b, e, name  = result[i]
-                    L.debug(beta_a)
-                    L.debug(beta_b)
-                    L.debug(name)
-                    devName = self.ele2dev[name]
-                    if devName not in self.profiles:
-                        continue
-                    #CGI
-                    beamProps = {'beta_a': float(beta_a), 'beta_b': float(beta_b), 'x': float(orbit_x), 'y': float(orbit_y), 'e': float(e)}
-                    image = self.gen_beam_image(beamProps, self.profiles[devName]['props']['values'], img_type = "not_smooth")
-                    self.profiles[devName]['image'] = image.tolist()
-            else: 
-                md = await model_broadcast_socket.recv(flags=flags, copy=copy, track=track)
-                
-           # L.info("Checking for new profile orbits.")
-           # md = await model_broadcast_socket.recv_pyobj(flags=flags)            
-           # if md.get("tag", None) == "prof_orbit":
-           #     msg="Profile orbit incoming: {}".format( md)
-           #     L.info(msg)
-           #     msg = await model_broadcast_socket.recv(flags=flags, copy=copy, track=track)
-           #     buf = memoryview(msg)
-           #     A = np.frombuffer(buf, dtype=md['dtype'])
-           #     orbit = A.reshape(md['shape'])
-           # else:
-           #     await model_broadcast_socket.recv(flags=flags, copy=copy, track=track)
-            
-            
-               #devName = self.ele2dev[name]
-                #if devName not in self.profiles:
-                #    continue
-                #CGI
-                #beamProps = {'beta_a': float(beta_a), 'beta_b': float(beta_b), 'x': orbit[0][i], 'y': orbit[1][i]}
-                #image = self.gen_beam_image(beamProps, self.profiles[devName]['props']['values'], smooth=False)
-                #self.profiles[devName]['image'] = image.tolist()
-            
-            await self.publish_profiles()
+    async def on_particle_positions(self, message):
+        #One message per screen, with an (n_particles, 2) array of x and y, and the element name in an extra frame.
+        screen = bytes(message.extra[0]).decode()
+        L.debug("Got new particle positions for {}".format(screen))
+        devName = self.ele2dev.get(screen)
+        if devName not in self.profiles or len(message.payload) == 0:
+            return
+        #Screens with tracked particles don't fall back to the gaussian from the profile data.
+        self.tracked_screens.add(devName)
+        beamProps = { 'particlePos': message.payload}
+        image = self.gen_beam_image(beamProps, self.profiles[devName]['props']['values'], img_type="positions")
+        self.profiles[devName]['image'] = image.tolist()
+        await self.publish_profiles()
+
+    async def on_profile_data(self, message):
+        msg ="Profile data incoming: {}".format(message.header)
+        L.info(msg)
+        result = np.rot90(message.payload)
+        for i in range(result.shape[0]):
+            orbit_x, orbit_y, beta_a, beta_b, e, name  = result[i]
+            L.debug(beta_a)
+            L.debug(beta_b)
+            L.debug(name)
+            devName = self.ele2dev[name]
+            if devName not in self.profiles or devName in self.tracked_screens:
+                continue
+            #CGI
+            beamProps = {'beta_a': float(beta_a), 'beta_b': float(beta_b), 'x': float(orbit_x), 'y': float(orbit_y), 'e': float(e)}
+            image = self.gen_beam_image(beamProps, self.profiles[devName]['props']['values'], img_type = "not_smooth")
+            self.profiles[devName]['image'] = image.tolist()
+        await self.publish_profiles()
 
     async def publish_profiles(self):
         for key, profile in self.profiles.items():
@@ -276,8 +245,8 @@ def main():
     _, run_options = ioc_arg_parser(
         default_prefix='',
         desc="Simulated Profile Monitor Service")
-    loop.create_task(service.recv_profiles())
-    loop.call_soon(service.request_profiles)
+    loop.create_task(service.subscriber.run())
+    loop.create_task(service.request_profiles())
     run(service, **run_options)
     
 if __name__ == '__main__':
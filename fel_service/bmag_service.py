@@ -7,7 +7,6 @@ from collections import OrderedDict
 from caproto.server import ioc_arg_parser, run, pvproperty, PVGroup
 from caproto import ChannelType, ChannelDouble
 import simulacrum
-import zmq
 from zmq.asyncio import Context
 
 #set up python logger
@@ -31,20 +30,18 @@ class BMAGService(simulacrum.Service):
 
         #network stuff  
         self.ctx = Context.instance()
-        #cmd socket is a synchronous socket, we don't want the asyncio context.
-        self.cmd_socket = zmq.Context().socket(zmq.REQ)
-        self.cmd_socket.connect("tcp://127.0.0.1:{}".format(os.environ.get('MODEL_PORT', 12312)))
+        self.model_client = simulacrum.ModelClient()
+        self.subscriber = simulacrum.Subscriber(ctx=self.ctx)
+        self.subscriber.subscribe(simulacrum.broadcast.UND_TWISS, self.on_twiss)
 
         #collect and parse design and current twiss at UNDSTART from model.
         #Sadly, the different beamlines give this marker point different names.  We just try all of em.            
         und_marker_points = ("UNDSTART", "BEGUNDH", "BEGUNDS")
         for marker_point in und_marker_points:
-            self.cmd_socket.send_pyobj({"cmd" : "tao", "val" : "show lat -design -no_label_lines -at alpha_a -at beta_a -at alpha_b -at beta_b {}".format(marker_point)})
-            response = self.cmd_socket.recv_pyobj()
+            response = self.model_client.request_sync({"cmd" : "tao", "val" : "show lat -design -no_label_lines -at alpha_a -at beta_a -at alpha_b -at beta_b {}".format(marker_point)})
             if "ERROR" not in response['result'][0]:
                 self.design = self.get_init_data(response)
-                self.cmd_socket.send_pyobj({"cmd" : "tao", "val" : "show lat -no_label_lines -at alpha_a -at beta_a -at alpha_b -at beta_b {}".format(marker_point)})
-                response = self.cmd_socket.recv_pyobj()
+                response = self.model_client.request_sync({"cmd" : "tao", "val" : "show lat -no_label_lines -at alpha_a -at beta_a -at alpha_b -at beta_b {}".format(marker_point)})
                 self.model = self.get_init_data(response)
                 break
             
@@ -78,38 +75,25 @@ class BMAGService(simulacrum.Service):
         return [x_bmag, y_bmag, np.sqrt(x_bmag*y_bmag)]
     
     #listen for twiss objects from model
-    def request_twiss(self):
-        self.cmd_socket.send_pyobj({"cmd" : "send_und_twiss"})
-        return self.cmd_socket.recv_pyobj()
+    async def request_twiss(self):
+        return await self.model_client.request({"cmd" : "send_und_twiss"})
    
     #accept twiss list from model
-    async def recv_twiss_list(self, flags=0, copy=False, track=False):
-        model_broadcast_socket = self.ctx.socket(zmq.SUB)
-        model_broadcast_socket.connect('tcp://127.0.0.1:{}'.format(os.environ.get('MODEL_BROADCAST_PORT', 66666)))
-        model_broadcast_socket.setsockopt(zmq.SUBSCRIBE, b'')
-        while True:
-            L.info("Checking for new twiss data.")
-            md = await model_broadcast_socket.recv_pyobj(flags=flags)
-            msg="Some data incoming: {}".format( md)
-            L.info(msg)
-            if md.get("tag", None) == "und_twiss":
-                msg="Twiss data incoming: {}".format( md)
-                L.info(msg)
-                msg = await model_broadcast_socket.recv_pyobj(flags=flags) #does this look right if I am sending twiss list as a pyobj? 
-                self.model = self.get_data(msg)
-                self.bmags = self.calc_bmag()
-                msg='Bmags: {}'.format( self.bmags)
-                L.debug(msg)
-                #fill single value PVs
-                await self['GDET:FEE1:241:ENRCX'].write(self.bmags[0])
-                await self['GDET:FEE1:241:ENRCY'].write(self.bmags[1])
-                await self['GDET:FEE1:241:ENRC'].write(self.bmags[2])
-                #circle history buffer and update first value
-                
-                msg = 'Buffer: {}'.format( self['GDET:FEE1:241:ENRCHSTBR'].value )
-                L.debug(msg)
-            else: 
-                msg = await model_broadcast_socket.recv(flags=flags)
+    async def on_twiss(self, message):
+        msg="Twiss data incoming: {}".format(message.header)
+        L.info(msg)
+        self.model = self.get_data(message.payload)
+        self.bmags = self.calc_bmag()
+        msg='Bmags: {}'.format( self.bmags)
+        L.debug(msg)
+        #fill single value PVs
+        await self['GDET:FEE1:241:ENRCX'].write(self.bmags[0])
+        await self['GDET:FEE1:241:ENRCY'].write(self.bmags[1])
+        await self['GDET:FEE1:241:ENRC'].write(self.bmags[2])
+        #circle history buffer and update first value
+        
+        msg = 'Buffer: {}'.format( self['GDET:FEE1:241:ENRCHSTBR'].value )
+        L.debug(msg)
 
     #update buffer PV from Gaussian distribution around BMAG
     async def rotate_buffer(self): 
@@ -134,10 +118,10 @@ def main():
     _, run_options = ioc_arg_parser(
         default_prefix='',
         desc="Simulated Undulator Match Service")
-    loop.create_task(service.recv_twiss_list())
+    loop.create_task(service.subscriber.run())
     loop.create_task(service.rotate_buffer())
     loop.create_task(service.print_buffer())
-    loop.call_soon(service.request_twiss)
+    loop.create_task(service.request_twiss())
     run(service, **run_options)
     
 if __name__ == '__main__':
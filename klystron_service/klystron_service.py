@@ -6,7 +6,6 @@ from collections import OrderedDict
 from caproto.server import ioc_arg_parser, run, pvproperty, PVGroup
 from caproto import ChannelType
 import simulacrum
-import zmq
 from zmq.asyncio import Context
 
 #set up python logger
@@ -298,14 +297,14 @@ class KlystronPV(PVGroup):
         if value == "TRIM":
             await asyncio.sleep(0.2)
             await ioc.phas.write(ioc.pdes.value)
-            self.change_callback(self, ioc.phas.value, "PHAS")
+            await self.change_callback(self, ioc.phas.value, "PHAS")
         else:
             L.warning("Warning, only valid function is TRIM.")
         return 0
 
     @enld.putter
     async def enld(self, instance, value):
-        self.change_callback(self, value, "ENLD")
+        await self.change_callback(self, value, "ENLD")
         return value
 
     @bc1_tctl.putter
@@ -322,11 +321,11 @@ class KlystronPV(PVGroup):
             await self.ampl.write(100.0)
         else:
             await self.ampl.write(0.0)
-        self.change_callback(self, is_on, "IS_ON")
+        await self.change_callback(self, is_on, "IS_ON")
 
 def _parse_klys_table(table):
-    splits = [row.split() for row in table]
-    return {'KLYS:LI{0}:{1}1'.format(ele_name[3:5],ele_name[6:8]): ( float(bmadEnld), float(bmadPhas), float(bmadEnld) > 1 ) for (_, ele_name, _, _, _, bmadEnld, bmadPhas) in splits}
+    """table is a list of (element name, ENLD_MeV, Phase_Deg) rows."""
+    return {'KLYS:LI{0}:{1}1'.format(ele_name[3:5],ele_name[6:8]): ( float(bmadEnld), float(bmadPhas), float(bmadEnld) > 1 ) for (ele_name, bmadEnld, bmadPhas) in table}
 
 def convert_device_to_element(device_name):
     return 'O_K{0}_{1}'.format(device_name[7:9],device_name[10])
@@ -339,8 +338,7 @@ def _parse_cudklys_table(table):
     Right now we basically just want a list of device names, eventually 
     this might actually do something useful.
     """
-    splits = [row.split() for row in table]
-    return {'CUDKLYS:LI{0}:{1}'.format(ele_name[3:5], ele_name[6:8]): 0 for (_, ele_name, _, _, _, _, _) in splits}  
+    return {'CUDKLYS:LI{0}:{1}'.format(ele_name[3:5], ele_name[6:8]): 0 for (ele_name, _, _) in table}  
 
 
 class KlystronService(simulacrum.Service):
@@ -348,9 +346,7 @@ class KlystronService(simulacrum.Service):
     def __init__(self):
         super().__init__()
         self.ctx = Context.instance()
-        #cmd socket is a synchronous socket, we don't want the asyncio context.
-        self.cmd_socket = zmq.Context().socket(zmq.REQ)
-        self.cmd_socket.connect("tcp://127.0.0.1:{}".format(os.environ.get('MODEL_PORT', 12312)))
+        self.model_client = simulacrum.ModelClient()
         init_vals, init_cud_vals = self.get_klystron_ACTs_from_model()
         init_sbst_vals = self.get_sbst_ACTs_from_model()
         klys_pvs = {device_name: KlystronPV(device_name, convert_device_to_element(device_name), self.on_klystron_change, initial_values=init_vals[device_name], prefix=device_name) for device_name in init_vals.keys()}
@@ -365,10 +361,9 @@ class KlystronService(simulacrum.Service):
     def get_klystron_ACTs_from_model(self):
         init_vals = {}
         init_CudVals = {}
-        self.cmd_socket.send_pyobj({"cmd": "tao", "val": "show lat -no_label_lines -attribute ENLD_MeV -attribute Phase_Deg O_K*"})
-        table = self.cmd_socket.recv_pyobj()['result']
+        table = self.model_client.lat_query_sync("O_K*", ["ENLD_MeV", "Phase_Deg"], track_only=False).tolist()
         # We inject our own static data for the injector and TCAV stations, which aren't modelled.
-        injector_stat = ['0 O_K20_5 Lcavity 5.6 --- 100 0', '0 O_K20_6 Lcavity 0.5 --- 6 0' , '0 O_K20_7 Lcavity 1.518 --- 58.5 0' ,  '0 O_K20_8 Lcavity 5.362 --- 114.0 0',  '0 O_K24_8 Lcavity 160 --- 114.0 0']
+        injector_stat = [('O_K20_5', 100, 0), ('O_K20_6', 6, 0), ('O_K20_7', 58.5, 0), ('O_K20_8', 114.0, 0), ('O_K24_8', 114.0, 0)]
         table.extend(injector_stat)
         init_vals = _parse_klys_table(table)
         init_CudVals = _parse_cudklys_table(table)
@@ -380,7 +375,7 @@ class KlystronService(simulacrum.Service):
             init_vals[f'SBST:LI{ii}:1'] = (0,0)
         return init_vals
 
-    def on_klystron_change(self, klystron_pv, value, parameter):
+    async def on_klystron_change(self, klystron_pv, value, parameter):
         element = klystron_pv.element_name
         if parameter == "PHAS":
             klys_attr = "Phase_Deg"
@@ -393,9 +388,8 @@ class KlystronService(simulacrum.Service):
 
         cmd = f'set ele {element} {klys_attr} = {value}'
         L.info(cmd)
-        self.cmd_socket.send_pyobj({"cmd": "tao", "val": cmd})
-        msg = self.cmd_socket.recv_pyobj()['result']
-        L.info(msg)
+        msg = await self.model_client.request({"cmd": "tao", "val": cmd})
+        L.info(msg.get('result'))
    
 def main():
     service = KlystronService()
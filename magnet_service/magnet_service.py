@@ -9,7 +9,6 @@ from caproto.server import ioc_arg_parser, run, pvproperty, PVGroup
 from caproto.server.records import _Limits
 from caproto import ChannelType
 import simulacrum
-import zmq
 from zmq.asyncio import Context
 
 #set up python logger
@@ -172,22 +171,19 @@ class MagnetPV(PVGroup):
         return value
 
 def _parse_corr_table(table):
-    """ Build a dictionary of element_name -> (BACT)."""
+    """ Build a dictionary of element_name -> (BACT) from a lat_query table with 'l' and 'bl_kick' columns."""
     # We use the 'tesla_to_kGm' function here for both bends and quads,
     # even though quads actually just use kG units (not kG*m).
     # This is because BMAD specifies quad strength as a gradient (T/m),
     # so the math is the same for quads and bends.
-    splits = [row.split() for row in table]
-    return {simulacrum.util.convert_element_to_device(ele_name): {"length": float(l), "bact": bl_kick_to_BACT(float(bl_kick))} for (_, ele_name, _, _, l, bl_kick) in splits if ele_name in simulacrum.util.element_names}
+    return {simulacrum.util.convert_element_to_device(ele_name): {"length": float(l), "bact": bl_kick_to_BACT(float(bl_kick))} for (ele_name, l, bl_kick) in table[["name", "l", "bl_kick"]].tolist() if ele_name in simulacrum.util.element_names}
 
 def _parse_quad_table(table):
-    splits = [row.split() for row in table]
-    return {simulacrum.util.convert_element_to_device(ele_name): {"length": float(l), "bact": quad_gradient_to_BACT(float(b1_gradient), float(l))} for (_, ele_name, _, _, l, b1_gradient) in splits if ele_name in simulacrum.util.element_names}
+    return {simulacrum.util.convert_element_to_device(ele_name): {"length": float(l), "bact": quad_gradient_to_BACT(float(b1_gradient), float(l))} for (ele_name, l, b1_gradient) in table[["name", "l", "b1_gradient"]].tolist() if ele_name in simulacrum.util.element_names}
 
 def _parse_bend_table(table):
-    splits = [row.split() for row in table]
     return {simulacrum.util.convert_element_to_device(ele_name): {"length": float(l), "bact": bend_b_field_to_BACT(float(b_field), float(l))} 
-        for (_, ele_name, _, _, l, b_field) in splits if ele_name in simulacrum.util.element_names}
+        for (ele_name, l, b_field) in table[["name", "l", "b_field"]].tolist() if ele_name in simulacrum.util.element_names}
 
 def bl_kick_to_BACT(bl_kick, l=None):
     """Convert the bl_kick attribute (T*m) for a corrector into SLAC BACT compatible kG*m units"""
@@ -219,9 +215,7 @@ class MagnetService(simulacrum.Service):
     def __init__(self):
         super().__init__()
         self.ctx = Context.instance()
-        #cmd socket is a synchronous socket, we don't want the asyncio context.
-        self.cmd_socket = zmq.Context().socket(zmq.REQ)
-        self.cmd_socket.connect("tcp://127.0.0.1:{}".format(os.environ.get('MODEL_PORT', 12312)))
+        self.model_client = simulacrum.ModelClient()
         init_vals = self.get_initial_values()
         magnet_element_list = self.get_magnet_list_from_model()
         magnet_device_list = [simulacrum.util.convert_element_to_device(element) for element in magnet_element_list]
@@ -234,14 +228,12 @@ class MagnetService(simulacrum.Service):
         
         # Now that we've set up all the magnets, we need to send the model a
         # command to use non-normalized magnetic field units.
-        self.cmd_socket.send_pyobj({"cmd": "tao", "val": "set ele Kicker::*,Quadrupole::*,Sbend::* field_master = T"})
-        self.cmd_socket.recv_pyobj()
+        self.model_client.request_sync({"cmd": "tao", "val": "set ele Kicker::*,Quadrupole::*,Sbend::* field_master = T"})
         L.info("Initialization complete.")
         
     def get_magnet_list_from_model(self):
         element_list = []
-        self.cmd_socket.send_pyobj({"cmd": "tao", "val": "show ele -no_slaves Kicker::*,Quadrupole::*"})
-        for row in self.cmd_socket.recv_pyobj()['result'][:-1]:
+        for row in self.model_client.tao_sync("show ele -no_slaves Kicker::*,Quadrupole::*")[:-1]:
             element_list.append(row.split(None, 3)[1])
         return element_list
     
@@ -263,9 +255,8 @@ class MagnetService(simulacrum.Service):
     def get_magnet_BACTs_from_model(self):
         init_vals = {}
         for (attr, dev_list, parse_func) in [("bl_kick", "Hkicker::X*", _parse_corr_table), ("bl_kick", "Vkicker::Y*", _parse_corr_table), ("b1_gradient", "Quadrupole::*", _parse_quad_table), ("b_field", "Sbend::*", _parse_bend_table)]:
-            self.cmd_socket.send_pyobj({"cmd": "tao", "val": "show lat -no_label_lines -attribute {attr} {list}".format(attr=attr, list=dev_list)})
-            table = self.cmd_socket.recv_pyobj()
-            init_vals.update(parse_func(table['result']))
+            table = self.model_client.lat_query_sync(dev_list, ["l", attr], track_only=False, no_slaves=True)
+            init_vals.update(parse_func(table))
         return init_vals
 
     async def on_magnet_change(self, magnet_pv, value):
@@ -275,10 +266,9 @@ class MagnetService(simulacrum.Service):
         conv = self.conversion_to_BMAD_for_mag_type[mag_type]
         l = magnet_pv.length
         L.debug('Updating {}... '.format(magnet_pv.device_name))
-        self.cmd_socket.send_pyobj({"cmd": "tao", "val": "set ele {element} {attr} = {val}".format(element=magnet_pv.element_name, 
-                                                                                                   attr=mag_attr,
-                                                                                                   val=conv(value, l))})
-        self.cmd_socket.recv_pyobj()
+        await self.model_client.request({"cmd": "tao", "val": "set ele {element} {attr} = {val}".format(element=magnet_pv.element_name,
+                                                                                                        attr=mag_attr,
+                                                                                                        val=conv(value, l))})
         L.debug('Updated {}.'.format(magnet_pv.device_name))
 
     def make_bends(self):
@@ -322,20 +312,18 @@ class MagnetService(simulacrum.Service):
                     "BYKIK1S": "BYKIK1S", "BYKIK2S": "BYKIK1S",
                    }
         # Get a list of all bends, and the attributes we need to use them.
-        self.cmd_socket.send_pyobj({"cmd": "tao", "val": "show lat -tracking_elements -no_label_lines -attribute g -attribute b_field -attribute b_field_err SBend::*"})
-        result = self.cmd_socket.recv_pyobj()
+        table = self.model_client.lat_query_sync("SBend::*", ["l", "g", "b_field", "b_field_err"])
         # Parse this list, make all the conversion factors, and create the magnet PVs for the bends.
         # We store them in a 'bends' dictionary, keyed on the element name of the master bend.
         bends = {}
         master_bends = {}
-        for line in result['result']:
-            L.debug(line)
-            s = line.split()
-            element_name = s[1]
-            l = float(s[4]) # Length of the magnet (in meters)
-            g = float(s[5]) # g = 1/rho, where rho is bend radius.  g has units of 1/meter
-            b_init_tesla = float(s[6]) # The "design" magnetic field for the magnet, in tesla.
-            b_field_err_init = float(s[7]) # The "field error" for this magnet, in tesla.
+        for row in table:
+            L.debug(row)
+            element_name = str(row['name'])
+            l = float(row['l']) # Length of the magnet (in meters)
+            g = float(row['g']) # g = 1/rho, where rho is bend radius.  g has units of 1/meter
+            b_init_tesla = float(row['b_field']) # The "design" magnetic field for the magnet, in tesla.
+            b_field_err_init = float(row['b_field_err']) # The "field error" for this magnet, in tesla.
             # Make a 'BendElement', which is usually half of a bend, for every item in this list.
             bend_type = None
             if element_name in chicane_bends:
@@ -363,7 +351,7 @@ class MagnetService(simulacrum.Service):
             # Determine the 'master' bend.
             master_bend = master_bends[string_name]
             L.debug("Making a string for {}.  Bend list: {}.  Master: {}".format(string_name, [bend.element_name for bend in bends_for_string], master_bend.element_name))
-            bend_strings.append(BendString(bends_for_string, master_bend, self.cmd_socket))
+            bend_strings.append(BendString(bends_for_string, master_bend, self.model_client))
         
         # Make all the PV objects.
         path_to_limits_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), "magnet_limits.json")
@@ -437,19 +425,18 @@ class Bend:
 class BendString:
     """ Represents a whole string of bends.  This class is responsible for
         setting magnet strengths in the model. """
-    def __init__(self, bends, master, cmd_socket):
+    def __init__(self, bends, master, model_client):
         self.bends = bends
         self.master_bend = master
-        self.cmd_socket = cmd_socket
+        self.model_client = model_client
     
-    def send_field_strength_to_model(self, b_field_from_epics):
+    async def send_field_strength_to_model(self, b_field_from_epics):
         commands = []
         for bend in self.bends:
             sub_command = bend.set_field_strength_command(b_field_from_epics)
             commands.append(sub_command)
-        L.debug("Sending batch to model: {}".format(commands))
-        self.cmd_socket.send_pyobj({"cmd": "tao_batch", "val": commands})
-        return self.cmd_socket.recv_pyobj()
+        L.debug("Sending transaction to model: {}".format(commands))
+        return await self.model_client.request({"cmd": "transaction", "val": commands})
     
     def make_pvs(self, limit_vals):
         for bend in self.bends:
@@ -461,7 +448,7 @@ class BendString:
         # Now make the master bend PV        
         async def change_callback(magnet_pv, value):
             L.debug("Changing bend strength to %f", value)
-            self.send_field_strength_to_model(value)
+            await self.send_field_strength_to_model(value)
             for bend in self.bends:
                 if bend != self.master_bend:
                     # Update all the non-master bend PVs, without triggering their callbacks.
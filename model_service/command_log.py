@@ -0,0 +1,215 @@
+"""
+A log of the 'set' commands that have changed the live model, so the live
+lattice can be rebuilt somewhere else (a scan worker, for example) by
+replaying it on top of the design lattice.  The log can also be kept on disk
+(see Journal), so the live model can be rebuilt after a restart.
+"""
+import os
+import re
+import json
+import tempfile
+import threading
+from collections import OrderedDict
+
+#Captures the target and attribute of 'set ele <target> <attr> = <value>' and
+#'set particle_start <attr> = <value>'.
+SET_KEY_RE = re.compile(r"set\s+(?:ele(?:ment)?\s+(\S+)|particle_start)\s+(\w+)\s*=\s*[^,]*$", re.IGNORECASE)
+
+class CommandLog:
+    """
+    Commands are compacted as they are added, see CompactedCommands.
+    If keep_pending is True, every command is also kept, uncompacted, until
+    it is collected with take_pending.  This is how changes are streamed to
+    read replicas.
+    If a journal is given, durable commands are written to it as they are
+    added, and the compacted log is snapshotted every so often.  The last
+    durable command for each target and attribute is kept separately for
+    the snapshots, so a non-durable command (like jitter on an attribute a
+    service also sets) never replaces a setting that should survive a restart.
+    Commands are added from the Tao worker thread, and read from the event
+    loop, so access is protected by a lock.
+    """
+    def __init__(self, keep_pending=False, journal=None):
+        self.entries = CompactedCommands()
+        #The compacted durable commands only, for journal snapshots.
+        self.durable_entries = CompactedCommands()
+        self.generation = 0
+        self.pending = [] if keep_pending else None
+        self.journal = journal
+        self.lock = threading.Lock()
+
+    def append(self, generation, cmd, durable=True, write_journal=True):
+        """
+        durable is False for commands that shouldn't survive a restart, like jitter.
+        write_journal is False for commands that are already in the journal,
+        like the ones replayed after a restart.
+        """
+        with self.lock:
+            self.entries.add(cmd)
+            if durable:
+                self.durable_entries.add(cmd)
+            self.generation = generation
+            if self.pending is not None:
+                self.pending.append(cmd)
+            if self.journal is not None and durable and write_journal:
+                self.journal.append(cmd)
+                if self.journal.snapshot_due():
+                    self.journal.snapshot(self.durable_entries.commands())
+
+    def take_pending(self):
+        """
+        Returns: every command added since the last call, in order.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, []
+            return pending
+
+    def commands(self, durable_only=False):
+        """
+        Returns: a (generation, list of commands) tuple.  If durable_only is
+        True, the list leaves out non-durable commands like jitter.
+        """
+        with self.lock:
+            return self.generation, (self.durable_entries if durable_only else self.entries).commands()
+
+class CompactedCommands:
+    """
+    A list of commands, where a command that sets the same attribute of the
+    same target as an earlier one replaces it, and moves to the end.  That
+    is only done when no command in between touches the same target, since
+    commands on one element can depend on each other: a gradient means
+    something else before and after a 'field_master' change, for example.
+    So replaying the compacted list gives the same lattice as replaying
+    every command.  A target with wildcards, lists or classes might be any
+    element, so it only replaces an earlier command if nothing came after
+    that one at all, and nothing that came after it is moved past it.
+    Commands that don't match SET_KEY_RE are never compacted.
+    """
+    def __init__(self):
+        #Sequence number -> command, in order.
+        self.entries = OrderedDict()
+        self.n_added = 0
+        #(target, attribute) -> sequence number of its last command.
+        self.last_for_key = {}
+        #target -> sequence number of the last command on that exact target.
+        self.last_for_target = {}
+        #Sequence number of the last command that might touch any element.
+        self.last_wildcard = -1
+
+    def add(self, cmd):
+        seq = self.n_added
+        self.n_added += 1
+        key = _key(cmd)
+        if key is None:
+            #Could do anything, so nothing is compacted across it.
+            self.entries[seq] = cmd
+            self.last_wildcard = seq
+            return
+        target = key[0]
+        previous = self.last_for_key.get(key)
+        if _is_wildcard(target):
+            if previous is not None and previous == next(reversed(self.entries)):
+                del self.entries[previous]
+            self.last_wildcard = seq
+        else:
+            if previous is not None and self.last_for_target.get(target) == previous and self.last_wildcard < previous:
+                del self.entries[previous]
+            self.last_for_target[target] = seq
+        self.entries[seq] = cmd
+        self.last_for_key[key] = seq
+
+    def commands(self):
+        return list(self.entries.values())
+
+    def __len__(self):
+        return len(self.entries)
+
+class Journal:
+    """
+    Keeps the command log on disk, in two files:
+        <name>_snapshot.json: the compacted log, as of the last snapshot.
+        <name>_journal.log: every command added since then, one JSON string per line.
+    Each line is flushed as it is written, so a crash of the model service
+    loses nothing.  Once the journal has snapshot_interval lines, the
+    snapshot is rewritten and the journal starts over.  The new snapshot
+    replaces the old one atomically, before the journal is truncated, so a
+    crash in between only means some commands are replayed twice.
+    Both files start with the lattice fingerprint, and are ignored if the
+    lattice has changed since they were written.
+    """
+    def __init__(self, directory, name, fingerprint, snapshot_interval=1000):
+        self.directory = directory
+        self.snapshot_path = os.path.join(directory, "{}_snapshot.json".format(name.lower()))
+        self.journal_path = os.path.join(directory, "{}_journal.log".format(name.lower()))
+        self.fingerprint = fingerprint
+        self.snapshot_interval = snapshot_interval
+        self.journal_file = None
+        self.n_lines = 0
+
+    def recover(self):
+        """
+        Reads the snapshot and journal.
+        Returns: the compacted list of commands, or an empty list if there is nothing to recover.
+        """
+        log = CommandLog()
+        try:
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+            if snapshot['fingerprint'] == self.fingerprint:
+                for cmd in snapshot['commands']:
+                    log.append(0, cmd)
+        except (OSError, ValueError, KeyError):
+            pass
+        try:
+            with open(self.journal_path) as f:
+                header = json.loads(f.readline())
+                if header['fingerprint'] == self.fingerprint:
+                    for line in f:
+                        try:
+                            log.append(0, json.loads(line))
+                        except ValueError:
+                            #The last line can be incomplete, if we crashed while writing it.
+                            break
+        except (OSError, ValueError, KeyError):
+            pass
+        return log.commands()[1]
+
+    def snapshot(self, commands):
+        """
+        Writes commands as the new snapshot, and starts a new, empty journal.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'fingerprint': self.fingerprint, 'commands': commands}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        if self.journal_file is not None:
+            self.journal_file.close()
+        self.journal_file = open(self.journal_path, 'w')
+        self.journal_file.write(json.dumps({'fingerprint': self.fingerprint}) + "\n")
+        self.journal_file.flush()
+        self.n_lines = 0
+
+    def append(self, cmd):
+        self.journal_file.write(json.dumps(cmd) + "\n")
+        self.journal_file.flush()
+        self.n_lines += 1
+
+    def snapshot_due(self):
+        return self.n_lines >= self.snapshot_interval
+
+def _key(cmd):
+    match = SET_KEY_RE.match(cmd.strip())
+    if match is None:
+        return None
+    target, attr = match.groups()
+    return ((target or "particle_start").upper(), attr.lower())
+
+def _is_wildcard(target):
+    return any(c in target for c in "*?%,:")
@@ -0,0 +1,129 @@
+"""
+Noise sources for the model service's jitter mode.  Each source perturbs one
+attribute, either of particle_start or of every element matching a selector,
+with a sum of three noise processes:
+    'white': independent gaussian noise on every tick, with this rms.
+    'drift': an AR(1) process with this rms, and a correlation time of
+             'drift_tau' seconds.  This is the slow wander of a real machine.
+    'line': a sinusoid with this rms, at 'line_hz' (default 60 Hz), with a
+            random phase for each element.  It is sampled at the wall clock
+            time of each tick, so it aliases like it would on the beam.
+If 'relative_to' is given, the rms values are fractions of that attribute of
+each element, as designed.  Noise is added to the attribute's current value,
+so settings made by other services are respected.  particle_start attributes
+are set to the noise alone, about zero.
+Sources can be loaded from a JSON file with a list of source dicts, see
+load_sources.  DEFAULT_SOURCES is used otherwise.
+"""
+import json
+import numpy as np
+
+DEFAULT_SOURCES = [
+    {'name': 'launch_x', 'attribute': 'x', 'white': 0.12e-3, 'drift': 0.05e-3, 'drift_tau': 60.0},
+    {'name': 'launch_y', 'attribute': 'y', 'white': 0.12e-3, 'drift': 0.05e-3, 'drift_tau': 60.0},
+    {'name': 'launch_px', 'attribute': 'px', 'white': 2e-6, 'drift': 1e-6, 'drift_tau': 60.0},
+    {'name': 'launch_py', 'attribute': 'py', 'white': 2e-6, 'drift': 1e-6, 'drift_tau': 60.0},
+    {'name': 'energy', 'attribute': 'pz', 'white': 1e-4, 'drift': 2e-4, 'drift_tau': 120.0},
+    {'name': 'klystron_amplitude', 'elements': 'Lcavity::*', 'attribute': 'gradient_err', 'relative_to': 'gradient', 'white': 5e-4, 'drift': 2e-4, 'drift_tau': 300.0},
+    #phi0 is in units of 2pi, so these are 0.1 and 0.05 degrees.
+    {'name': 'klystron_phase', 'elements': 'Lcavity::*', 'attribute': 'phi0_err', 'white': 0.1/360.0, 'drift': 0.05/360.0, 'drift_tau': 300.0},
+    {'name': 'magnet_ripple', 'elements': 'Sbend::*', 'attribute': 'b_field_err', 'relative_to': 'b_field', 'white': 2e-6, 'line': 1e-5, 'line_hz': 60.0},
+]
+
+def load_sources(path):
+    with open(path) as f:
+        return json.load(f)
+
+class JitterGroup:
+    """
+    The channels of one source: one per element, or a single one for particle_start.
+    mask picks the jittered elements out of every element the source's
+    selector matches, or is None if they all are.
+    """
+    def __init__(self, source, names, start, mask=None):
+        self.source = source
+        self.names = names
+        self.slice = slice(start, start + len(names))
+        self.mask = mask
+
+    def command(self, name, value):
+        if name is None:
+            return "set particle_start {} = {!r}".format(self.source['attribute'], float(value))
+        return "set ele {} {} = {!r}".format(name, self.source['attribute'], float(value))
+
+class JitterEngine:
+    """
+    Every channel's noise parameters and state are kept in flat arrays, so
+    one tick is a single vectorized draw for every source at once.
+    """
+    def __init__(self, period, seed=None):
+        self.period = period
+        self.rng = np.random.RandomState(seed)
+        self.groups = []
+        self.white = np.empty(0)
+        self.drift_a = np.empty(0)
+        self.drift_b = np.empty(0)
+        self.drift = np.empty(0)
+        self.line = np.empty(0)
+        self.omega = np.empty(0)
+        self.phase = np.empty(0)
+        #Values the noise is added to, and the values set on the last tick.
+        self.base = np.empty(0)
+        self.applied = np.empty(0)
+
+    @property
+    def n_channels(self):
+        return len(self.base)
+
+    def add_source(self, source, names, scales, mask=None):
+        """
+        Adds a channel for each name.  names is [None] for particle_start sources.
+        scales multiply the source's rms values, see 'relative_to'.
+        If only some of the elements the source's selector matches are
+        jittered, mask selects them, see JitterGroup.
+        """
+        n = len(names)
+        scales = np.broadcast_to(np.asarray(scales, dtype=np.float64), (n,))
+        a = np.exp(-self.period/source['drift_tau']) if source.get('drift', 0.0) else 0.0
+        drift = source.get('drift', 0.0)*scales
+        self.groups.append(JitterGroup(source, list(names), self.n_channels, mask))
+        self.white = np.concatenate((self.white, source.get('white', 0.0)*scales))
+        self.drift_a = np.concatenate((self.drift_a, np.full(n, a)))
+        self.drift_b = np.concatenate((self.drift_b, drift*np.sqrt(1.0 - a*a)))
+        #Start the drift from its stationary distribution.
+        self.drift = np.concatenate((self.drift, drift*self.rng.standard_normal(n)))
+        self.line = np.concatenate((self.line, source.get('line', 0.0)*np.sqrt(2.0)*scales))
+        self.omega = np.concatenate((self.omega, np.full(n, 2.0*np.pi*source.get('line_hz', 60.0))))
+        self.phase = np.concatenate((self.phase, self.rng.uniform(0.0, 2.0*np.pi, n)))
+        self.base = np.concatenate((self.base, np.zeros(n)))
+        self.applied = np.concatenate((self.applied, np.full(n, np.nan)))
+
+    def sample(self, t):
+        """
+        Advances every noise process by one tick.
+        Returns: the noise for every channel at time t.
+        """
+        w = self.rng.standard_normal((2, self.n_channels))
+        self.drift *= self.drift_a
+        self.drift += self.drift_b*w[1]
+        return self.white*w[0] + self.drift + self.line*np.sin(self.omega*t + self.phase)
+
+    def commands(self, t, current):
+        """
+        Returns: the 'set' commands for one tick at time t.
+        current has the current value of every element each group's selector
+        matches, or None for particle_start groups.  A value that differs from
+        the one set on the last tick was changed by someone else, and becomes
+        the new base.
+        """
+        values = self.sample(t)
+        for group, group_current in zip(self.groups, current):
+            if group_current is not None:
+                if group.mask is not None:
+                    group_current = group_current[group.mask]
+                base = self.base[group.slice]
+                changed = ~np.isclose(group_current, self.applied[group.slice], rtol=1e-9, atol=0.0)
+                base[changed] = group_current[changed]
+            values[group.slice] += self.base[group.slice]
+        self.applied = values
+        return [group.command(name, value) for group in self.groups for name, value in zip(group.names, values[group.slice])]
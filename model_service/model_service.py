@@ -1,42 +1,240 @@
 #!/usr/bin/env python3
 import os
+import re
 import argparse
 import sys
 import pickle
 import asyncio
 import time
+import threading
+import itertools
+import fnmatch
+import hashlib
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import zmq
 import pytao
-from p4p.nt import NTTable
+from p4p import Value
+from p4p.nt import NTTable, NTNDArray
 from p4p.server import Server as PVAServer
 from p4p.server.asyncio import SharedPV
 from zmq.asyncio import Context
 import simulacrum
+from simulacrum import broadcast
+import startup_cache
+import scan_worker
+import jitter
+from command_log import CommandLog, Journal
 
 
 model_service_dir = os.path.dirname(os.path.realpath(__file__))
+#Lattice attributes fetched for the TWISS and RMAT tables, one 'python lat_list' call each.
+TWISS_TABLE_ATTRS = ("ele.s", "ele.l", "orbit.energy", "ele.a.alpha", "ele.a.beta", "ele.x.eta", "ele.x.etap", "ele.a.phi", "ele.b.alpha", "ele.b.beta", "ele.y.eta", "ele.y.etap", "ele.b.phi", "ele.mat6")
+#Matches 'set ele <name> ...' and 'set element <name> ...' commands, capturing the element.
+SET_ELE_RE = re.compile(r"set\s+ele(?:ment)?\s+([^\s*%,:>]+)\s", re.IGNORECASE)
+#Elements the orbit and profile monitor broadcasts are reported at.  These match
+#the element lists the BPM and camera services build their PVs from.
+BPM_ELEMENTS = "BPM*,RFB*"
+PROFILE_ELEMENTS = "Monitor::OTR*,Monitor::YAG*"
+#Device name prefixes of the horizontal and vertical correctors in the orbit response matrix.
+XCOR_PREFIX = "XCOR"
+YCOR_PREFIX = "YCOR"
+#(TWISS table column, lattice attribute) pairs.
+TWISS_COLUMN_ATTRS = (("p0c", "orbit.energy"),
+                      ("alpha_x", "ele.a.alpha"), ("beta_x", "ele.a.beta"), ("eta_x", "ele.x.eta"), ("etap_x", "ele.x.etap"), ("psi_x", "ele.a.phi"),
+                      ("alpha_y", "ele.b.alpha"), ("beta_y", "ele.b.beta"), ("eta_y", "ele.y.eta"), ("etap_y", "ele.y.etap"), ("psi_y", "ele.b.phi"))
+#Tao commands that never change the lattice, so their results can be cached.  See CommandCache.
+READ_ONLY_CMD_PREFIXES = ("show ", "python lat_list ", "python ele:", "python lat_ele_list ", "python lat_general ")
+#Commands allowed in a transaction.  These only change the lattice, so a failed
+#transaction can be rolled back by restoring a copy of the lattice.
+TRANSACTION_CMD_RE = re.compile(r"set\s+(?:ele(?:ment)?|particle_start)\s", re.IGNORECASE)
+#Open transactions that haven't been committed or aborted after this many seconds are discarded.
+TRANSACTION_TIMEOUT = 60.0
+#Matches 'set ele <name> <kick attribute> = <value>', for the fast orbit mode.  See fast_kick.
+SET_KICK_RE = re.compile(r"set\s+ele(?:ment)?\s+([^\s*%,:>]+)\s+(bl_hkick|bl_vkick|hkick|vkick)\s*=\s*(\S+)\s*$", re.IGNORECASE)
+C_LIGHT = 299792458.0
+#Charge of the reference particle, in units of e.  Bmad normalizes field
+#attributes like bl_hkick to it.  Every Simulacrum model is an electron beamline.
+REFERENCE_CHARGE = -1.0
 #set up python logger
 L = simulacrum.util.SimulacrumLog(os.path.splitext(os.path.basename(__file__))[0], level='INFO')
 
+class CommandCache:
+    """
+    An LRU cache of read-only Tao command results, keyed on (generation, command).
+    The model generation changes every time the lattice does, so every entry
+    from an older generation is dropped as soon as a newer one is stored, and
+    results from an older generation that arrive late are not stored at all.
+    Results are lists of lines, or numpy arrays for lat_query tables, which
+    are keyed on a tuple (see lat_query_key), and are stored read-only.
+    Results are added from the Tao worker thread, and looked up from the event
+    loop, so access is protected by a lock.
+    """
+    def __init__(self, max_entries=1024, max_bytes=64*1024*1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.generation = None
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, generation, cmd):
+        """
+        Returns a copy of the cached result list for cmd, or None if there isn't one.
+        """
+        with self.lock:
+            result = self.entries.get((generation, cmd))
+            if result is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end((generation, cmd))
+            self.hits += 1
+            if isinstance(result[0], np.ndarray):
+                return result[0]
+            return list(result[0])
+
+    def put(self, generation, cmd, result):
+        if isinstance(result, np.ndarray):
+            size = result.nbytes
+            result.flags.writeable = False
+        else:
+            size = sys.getsizeof(result) + sum(sys.getsizeof(line) for line in result)
+            result = tuple(result)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if self.generation is not None and generation < self.generation:
+                #A slow result, like a replica read that finished after a change.
+                return
+            if generation != self.generation:
+                self._clear()
+                self.generation = generation
+            key = (generation, cmd)
+            if key in self.entries:
+                self.n_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (result, size)
+            self.n_bytes += size
+            while len(self.entries) > self.max_entries or self.n_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.n_bytes -= evicted_size
+
+    def clear(self):
+        with self.lock:
+            self._clear()
+
+    def _clear(self):
+        self.entries.clear()
+        self.n_bytes = 0
+
+class TransactionError(Exception):
+    pass
+
 class ModelService:
-    def __init__(self, init_file, name, enable_jitter=False, plot=False):
+    def __init__(self, init_file, name, enable_jitter=False, plot=False, coalesce_window=0.005, command_cache_bytes=64*1024*1024, use_startup_cache=True, fast_orbit=False, scan_workers=None, read_replicas=0, journal=True, fresh=False, jitter_sources=None, jitter_period=1.0, track_beam=False):
         self.name = name
-        tao_lib = os.environ.get('TAO_LIB', '')
-        self.tao = pytao.Tao(so_lib=tao_lib)
-        L.debug("Initializing Tao...")
-        if plot: 
-            self.tao.init("-init {init_file}".format(init_file=init_file))
-        else:
-            self.tao.init("-noplot -init {init_file}".format(init_file=init_file))
-        L.debug("Tao initialization complete!")
-        self.tao.cmd("set global lattice_calc_on = F")
-        self.tao.cmd('set global var_out_file = " "')
+        self.init_file = init_file
+        self.plot = plot
+        #Identifies the lattice files, for the startup cache and the journal.
+        self.lattice_fingerprint = startup_cache.lattice_fingerprint(init_file)
         self.ctx = Context.instance()
         self.model_broadcast_socket = zmq.Context().socket(zmq.PUB)
         self.model_broadcast_socket.bind("tcp://*:{}".format(os.environ.get('MODEL_BROADCAST_PORT', 66666)))
+        self.publisher = broadcast.Publisher(self.model_broadcast_socket)
+        #Bumped every time the lattice changes.  Broadcasts carry the generation
+        #of the model they were computed from.
+        self.generation = 0
+        self.command_cache = CommandCache(max_bytes=command_cache_bytes)
+        #Changes to the model that have been submitted to the Tao worker, but haven't
+        #finished.  The generation only changes when they run, so until then, the
+        #command cache and the replicas can't answer reads.  See run_tao_write.
+        self.pending_writes = 0
         self.loop = asyncio.get_event_loop()
+        #Every Tao call made after startup runs on this single worker thread. See run_tao.
+        self.tao_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tao")
         self.jitter_enabled = enable_jitter
+        #Noise sources for the jitter mode, see jitter.py.  The engine is built on
+        #the Tao worker, on the first tick, since sources are expanded into elements.
+        self.jitter_sources = jitter.DEFAULT_SOURCES if jitter_sources is None else jitter_sources
+        self.jitter_period = jitter_period
+        self.jitter = None
+        self.lattice_cache = None
+        #Reusable orbit buffers, keyed on element selector.  See fetch_orbit.
+        self.orbit_buffers = {}
+        #Open transactions: id -> (start time, list of queued commands).  See handle_command.
+        self.transactions = {}
+        self.transaction_ids = itertools.count(1)
+        #In fast orbit mode, corrector kicks are broadcast right away, as a linear
+        #prediction on top of the last broadcast orbits.  See fast_kick.
+        self.fast_orbit = fast_orbit
+        self.observer_indices = {}
+        self.last_orbit = None
+        self.last_prof_data = None
+        #Client-registered broadcast streams: query key -> stream dict.  See register_stream.
+        self.streams = OrderedDict()
+        #Worker processes for scans, each with its own Tao.  Started on the first scan.
+        self.scan_workers = scan_workers or os.cpu_count()
+        self.scan_pool = None
+        #Settings recovered from the journal, to replay on top of the design lattice.  See replay.
+        recovered = []
+        if journal:
+            self.journal = Journal(startup_cache.cache_dir(), name, self.lattice_fingerprint)
+            if not fresh:
+                recovered = self.journal.recover()
+            #Start a new journal from the compacted settings.
+            self.journal.snapshot(recovered)
+        else:
+            self.journal = None
+        #Every lattice change made to the live model, for rebuilding it in the scan workers,
+        #and for streaming to the read replicas.
+        self.command_log = CommandLog(keep_pending=read_replicas > 0 or track_beam, journal=self.journal)
+        #Read replicas are processes with their own Tao, which follow the live
+        #model through the command log, and serve read-only commands.  Each
+        #one has a single worker, so its tasks run in the order they were
+        #submitted.  See run_tao_cmd.
+        self.replicas = []
+        for _ in range(read_replicas):
+            replica = {'pool': multiprocessing.get_context("spawn").Pool(1, initializer=scan_worker.init_worker, initargs=(init_file,)),
+                       'outstanding': 0, 'ready': False}
+            replica['pool'].apply_async(scan_worker.sync, ([],), callback=lambda _, replica=replica: replica.update(ready=True))
+            self.replicas.append(replica)
+        #The generation the replicas have been synced to.
+        self.replica_generation = 0
+        #In beam tracking mode, a process with its own Tao follows the live model
+        #like a read replica, and tracks a beam distribution.  See track_beam.
+        self.beam_tracker = None
+        if track_beam:
+            self.beam_tracker = {'pool': multiprocessing.get_context("spawn").Pool(1, initializer=scan_worker.init_beam_worker, initargs=(init_file, PROFILE_ELEMENTS)),
+                                 'cmds': [], 'generation': 0, 'tracked_generation': None, 'busy': False}
+        #Results of read-only commands run before the first model change.  These
+        #are saved in the startup cache, along with the design lattice cache.
+        self.startup_results = {}
+        self.startup_save_pending = False
+        self.use_startup_cache = use_startup_cache
+        cached = None
+        if use_startup_cache:
+            cached = startup_cache.load(name, self.lattice_fingerprint)
+        if cached is None:
+            self.init_tao()
+            self.fetch_lattice_cache()
+            if use_startup_cache:
+                self.save_startup_cache()
+        else:
+            #Everything the tables and discovery queries need is already here,
+            #so Tao can finish initializing on the worker while we start serving.
+            L.info("Lattice is unchanged since the last start, using the startup cache.")
+            self.lattice_cache = cached['lattice_cache']
+            self.startup_results = cached['command_results']
+            for cmd, result in self.startup_results.items():
+                self.command_cache.put(0, cmd, result)
+            self.tao_executor.submit(self.init_tao).add_done_callback(self.tao_init_done)
+        if recovered:
+            #Nothing cached for the design lattice (generation 0) is valid anymore.
+            self.generation = 1
+            self.tao_executor.submit(self.replay, recovered)
         self.twiss_table = NTTable([("element", "s"), ("device_name", "s"),
                                        ("s", "d"), ("length", "d"), ("p0c", "d"),
                                        ("alpha_x", "d"), ("beta_x", "d"), ("eta_x", "d"), ("etap_x", "d"), ("psi_x", "d"),
@@ -48,14 +246,7 @@ class ModelService:
                               ("r41", "d"), ("r42", "d"), ("r43", "d"), ("r44", "d"), ("r45", "d"), ("r46", "d"),
                               ("r51", "d"), ("r52", "d"), ("r53", "d"), ("r54", "d"), ("r55", "d"), ("r56", "d"),
                               ("r61", "d"), ("r62", "d"), ("r63", "d"), ("r64", "d"), ("r65", "d"), ("r66", "d")])
-        initial_twiss_table, initial_rmat_table = self.get_twiss_table()
-        sec, nanosec = divmod(float(time.time()), 1.0)
-        initial_twiss_table = self.twiss_table.wrap(initial_twiss_table)
-        initial_twiss_table['timeStamp']['secondsPastEpoch'] = sec
-        initial_twiss_table['timeStamp']['nanoseconds'] = nanosec
-        initial_rmat_table = self.rmat_table.wrap(initial_rmat_table)
-        initial_rmat_table['timeStamp']['secondsPastEpoch'] = sec
-        initial_rmat_table['timeStamp']['nanoseconds'] = nanosec
+        initial_twiss_table, initial_rmat_table = self.wrap_tables(*self.tables_from_lattice_cache(self.lattice_cache))
         self.live_twiss_pv = SharedPV(nt=self.twiss_table, 
                            initial=initial_twiss_table,
                            loop=self.loop)
@@ -68,170 +259,501 @@ class ModelService:
         self.design_rmat_pv = SharedPV(nt=self.rmat_table, 
                            initial=initial_rmat_table,
                            loop=self.loop)
+        self.orm_array = NTNDArray()
+        self.orm = None
+        initial_orm = self.update_orm()
+        self.live_orm_pv = SharedPV(wrap=self.wrap_orm,
+                           initial=initial_orm,
+                           loop=self.loop)
+        self.design_orm_pv = SharedPV(wrap=self.wrap_orm,
+                           initial=initial_orm,
+                           loop=self.loop)
         self.recalc_needed = False
         self.pva_needs_refresh = False
+        self.pva_refresh_index = None
         self.need_zmq_broadcast = False
+        #How long to wait after a model change before recalculating, so that
+        #bursts of 'set' commands are coalesced into a single recalc.
+        self.coalesce_window = coalesce_window
+        self.model_change_event = asyncio.Event()
+        self.pva_refresh_event = asyncio.Event()
     
+    def init_tao(self):
+        tao_lib = os.environ.get('TAO_LIB', '')
+        self.tao = pytao.Tao(so_lib=tao_lib)
+        L.debug("Initializing Tao...")
+        if self.plot: 
+            self.tao.init("-init {init_file}".format(init_file=self.init_file))
+        else:
+            self.tao.init("-noplot -init {init_file}".format(init_file=self.init_file))
+        L.debug("Tao initialization complete!")
+        self.tao.cmd("set global lattice_calc_on = F")
+        self.tao.cmd('set global var_out_file = " "')
+
+    def replay(self, cmds):
+        """
+        Applies the settings recovered from the journal, then flags the model
+        for a single recalc, PVA refresh, and broadcast.  This runs on the Tao
+        worker, right after initialization, so every other request waits for it.
+        """
+        start_time = time.time()
+        n_failed = 0
+        for cmd in cmds:
+            try:
+                result = self.tao.cmd(cmd)
+            except Exception as e:
+                result = [str(e)]
+            if any("ERROR" in line for line in result):
+                L.warning("Could not restore '%s': %s", cmd, "\n".join(result))
+                n_failed += 1
+                continue
+            self.command_log.append(self.generation, cmd, write_journal=False)
+        L.info("Restored %d settings from the journal in %f seconds.", len(cmds) - n_failed, time.time() - start_time)
+        self.loop.call_soon_threadsafe(self.model_changed, 0)
+
+    def tao_init_done(self, future):
+        #Runs on the Tao worker thread, when a background initialization finishes.
+        if future.exception() is not None:
+            L.error("Tao initialization failed: %s", future.exception())
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        else:
+            L.info("Tao initialization complete.")
+
+    def save_startup_cache(self):
+        """
+        Writes the design lattice cache and startup_results to disk.  Once the
+        model has changed, neither of them describes the design lattice
+        anymore, so nothing is written.  This must run on the Tao worker (or
+        before the event loop starts), since the worker modifies the lattice cache.
+        """
+        self.startup_save_pending = False
+        if self.generation != 0:
+            return
+        try:
+            startup_cache.save(self.name, self.lattice_fingerprint, self.lattice_cache, self.startup_results)
+        except OSError as e:
+            L.warning("Could not write the startup cache: %s", e)
+
+    def startup_results_changed(self):
+        #Runs on the event loop.  Saves are batched, since services send
+        #their discovery queries in bursts when they start.
+        if not self.startup_save_pending:
+            self.startup_save_pending = True
+            self.loop.call_later(1.0, self.tao_executor.submit, self.save_startup_cache)
+
     def start(self):
         L.info("Starting %s Model Service.", self.name)
         pva_server = PVAServer(providers=[{f"SIMULACRUM:SYS0:1:{self.name}:LIVE:TWISS": self.live_twiss_pv,
                                            f"SIMULACRUM:SYS0:1:{self.name}:DESIGN:TWISS": self.design_twiss_pv,
                                            f"SIMULACRUM:SYS0:1:{self.name}:LIVE:RMAT": self.live_rmat_pv,
-                                           f"SIMULACRUM:SYS0:1:{self.name}:DESIGN:RMAT": self.design_rmat_pv,}])
+                                           f"SIMULACRUM:SYS0:1:{self.name}:DESIGN:RMAT": self.design_rmat_pv,
+                                           f"SIMULACRUM:SYS0:1:{self.name}:LIVE:ORM": self.live_orm_pv,
+                                           f"SIMULACRUM:SYS0:1:{self.name}:DESIGN:ORM": self.design_orm_pv,}])
         try:
             zmq_task = self.loop.create_task(self.recv())
             pva_refresh_task = self.loop.create_task(self.refresh_pva_table())
             broadcast_task = self.loop.create_task(self.broadcast_model_changes())
-            jitter_task = self.loop.create_task(self.add_jitter())
+            if self.beam_tracker is not None:
+                self.track_beam()
+            jitter_task = self.loop.create_task(self.add_jitter()) if self.jitter_enabled else None
             self.loop.run_forever()
         except KeyboardInterrupt:
             L.info("Shutting down Model Service.")
             zmq_task.cancel()
             pva_refresh_task.cancel()
             broadcast_task.cancel()
+            if jitter_task:
+                jitter_task.cancel()
             pva_server.stop()
+            self.tao_executor.shutdown(wait=False)
+            if self.scan_pool is not None:
+                self.scan_pool.terminate()
+            for replica in self.replicas:
+                replica['pool'].terminate()
+            if self.beam_tracker is not None:
+                self.beam_tracker['pool'].terminate()
         finally:
             self.loop.close()
             L.info("Model Service shutdown complete.")
     
-    def get_twiss_table(self):
+    def get_twiss_table(self, start_index=0):
         """
         Queries Tao for model and RMAT info.
-        Returns: A (twiss_table, rmat_table) tuple.
+        If start_index is greater than zero, only elements at or downstream of
+        that index are re-fetched from Tao.  Everything upstream is reused from
+        the previous call, including the cumulative RMAT product.
+        Returns: A (twiss_columns, rmat_columns) tuple.  Each is a dict mapping
+        an NTTable column name to a list or numpy array with one entry per element.
         """
         start_time = time.time()
+        cache = self.lattice_cache
+        if cache is not None and 0 < start_index < cache['n_elements']:
+            L.debug("Refreshing tables downstream of %s (s = %f m).", cache['element_names'][min(start_index, cache['n_rows']-1)], cache['ele.s'][start_index])
+        if cache is None or start_index <= 0 or not self.update_lattice_cache(start_index):
+            cache = self.fetch_lattice_cache()
+        twiss_columns, rmat_columns = self.tables_from_lattice_cache(cache)
+        end_time = time.time()
+        L.debug("get_twiss_table took %f seconds", end_time - start_time)
+        return twiss_columns, rmat_columns
+
+    def tables_from_lattice_cache(self, cache):
+        """
+        Builds the (twiss_columns, rmat_columns) tables from a lattice cache, without calling Tao.
+        """
+        n_rows = cache['n_rows']
+        common_columns = {"element": cache['element_names'], "device_name": cache['device_names'],
+                          "s": cache['ele.s'][:n_rows], "length": cache['ele.l'][:n_rows]}
+        twiss_columns = dict(common_columns)
+        for column, attr in TWISS_COLUMN_ATTRS:
+            twiss_columns[column] = cache[attr][:n_rows]
+        combined_rmats = cache['combined_rmats']
+        rmat_columns = dict(common_columns)
+        for i in range(6):
+            for j in range(6):
+                rmat_columns["r{}{}".format(i+1, j+1)] = combined_rmats[:, i, j]
+        return twiss_columns, rmat_columns
+
+    def fetch_lattice_cache(self):
+        """
+        Fetches the element list and every TWISS_TABLE_ATTRS column for the whole
+        lattice, and stores them in self.lattice_cache.
+        """
         #First we get a list of all the elements.
         #NOTE: the "-no_slaves" option for python lat_list only works in Tao 2019_1112 or above.
         element_name_list = self.tao.cmd("python lat_list -track_only 1@0>>*|model ele.name")
         L.debug(element_name_list)
-        for row in element_name_list:
-            assert "ERROR" not in element_name_list, "Fetching element names failed.  This is probably because a version of Tao older than 2019_1112 is being used."
+        assert "ERROR" not in element_name_list, "Fetching element names failed.  This is probably because a version of Tao older than 2019_1112 is being used."
         last_element_index = 0
-        for i, row in enumerate(reversed(element_name_list)):
-            if row == "END":
-                last_element_index = len(element_name_list)-1-i
-                break
-        element_data = {}
-        attrs = ("ele.s", "ele.l", "orbit.energy", "ele.a.alpha", "ele.a.beta", "ele.x.eta", "ele.x.etap", "ele.a.phi", "ele.b.alpha", "ele.b.beta", "ele.y.eta", "ele.y.etap", "ele.b.phi", "ele.mat6")
-        for attr in attrs:
-            element_data[attr] = self.tao.cmd_real("python lat_list -track_only 1@0>>*|model real:{}".format(attr))
+        if "END" in element_name_list:
+            last_element_index = len(element_name_list) - 1 - element_name_list[::-1].index("END")
+        n_rows = last_element_index + 1
+        cache = {"n_elements": len(element_name_list), "n_rows": n_rows}
+        for attr in TWISS_TABLE_ATTRS:
+            cache[attr] = self.tao.cmd_real("python lat_list -track_only 1@0>>*|model real:{}".format(attr))
             if attr == 'ele.mat6':
-                element_data[attr] = element_data[attr].reshape((-1, 6, 6))
-            assert len(element_data[attr]) == len(element_name_list), "Number of elements in model data for {} doesn't match number of element names.".format(attr)
-        
-        combined_rmat = np.identity(6)
-        twiss_table_rows = []
-        rmat_table_rows = []
-        for i in range(0,last_element_index+1):
-            element_name = element_name_list[i]
-            try:
-                device_name = simulacrum.util.convert_element_to_device(element_name.split("#")[0])
-            except KeyError:
-                device_name = ""
-            element_rmat = element_data['ele.mat6'][i]
-            rmat = np.matmul(element_rmat, combined_rmat)
-            combined_rmat = rmat
-            twiss_table_rows.append({"element": element_name, "device_name": device_name, "s": element_data['ele.s'][i], "length": element_data['ele.l'][i], "p0c": element_data['orbit.energy'][i],
-                               "alpha_x": element_data['ele.a.alpha'][i], "beta_x": element_data['ele.a.beta'][i], "eta_x": element_data['ele.x.eta'][i], "etap_x": element_data['ele.x.etap'][i], "psi_x": element_data['ele.a.phi'][i],
-                               "alpha_y": element_data['ele.b.alpha'][i], "beta_y": element_data['ele.b.beta'][i], "eta_y": element_data['ele.y.eta'][i], "etap_y": element_data['ele.y.etap'][i], "psi_y": element_data['ele.b.phi'][i]})
-            rmat_table_rows.append({
-                               "element": element_name, "device_name": device_name, "s": element_data['ele.s'][i], "length": element_data['ele.l'][i],
-                               "r11": rmat[0,0], "r12": rmat[0,1], "r13": rmat[0,2], "r14": rmat[0,3], "r15": rmat[0,4], "r16": rmat[0,5],
-                               "r21": rmat[1,0], "r22": rmat[1,1], "r23": rmat[1,2], "r24": rmat[1,3], "r25": rmat[1,4], "r26": rmat[1,5],
-                               "r31": rmat[2,0], "r32": rmat[2,1], "r33": rmat[2,2], "r34": rmat[2,3], "r35": rmat[2,4], "r36": rmat[2,5],
-                               "r41": rmat[3,0], "r42": rmat[3,1], "r43": rmat[3,2], "r44": rmat[3,3], "r45": rmat[3,4], "r46": rmat[3,5],
-                               "r51": rmat[4,0], "r52": rmat[4,1], "r53": rmat[4,2], "r54": rmat[4,3], "r55": rmat[4,4], "r56": rmat[4,5],
-                               "r61": rmat[5,0], "r62": rmat[5,1], "r63": rmat[5,2], "r64": rmat[5,3], "r65": rmat[5,4], "r66": rmat[5,5]})
-        end_time = time.time()
-        L.debug("get_twiss_table took %f seconds", end_time - start_time)
-        return twiss_table_rows, rmat_table_rows
+                cache[attr] = cache[attr].reshape((-1, 6, 6))
+            assert len(cache[attr]) == len(element_name_list), "Number of elements in model data for {} doesn't match number of element names.".format(attr)
+        cache['element_names'] = element_name_list[:n_rows]
+        cache['device_names'] = [simulacrum.util.ele2dev.get(element_name.split("#")[0], "") for element_name in cache['element_names']]
+        #Map each element name (and the base name of any slices, like Q1#1) to its first index.
+        element_index = {}
+        for i, element_name in enumerate(element_name_list):
+            element_index.setdefault(element_name, i)
+            element_index.setdefault(element_name.split("#")[0], i)
+        cache['element_index'] = element_index
+        cache['combined_rmats'] = _cumulative_rmats(cache['ele.mat6'][:n_rows])
+        self.lattice_cache = cache
+        return cache
+
+    def update_lattice_cache(self, start_index):
+        """
+        Re-fetches every TWISS_TABLE_ATTRS column for the elements from start_index
+        to the end of the lattice, and recomposes the cumulative RMATs downstream
+        of start_index on top of the cached product upstream of it.
+        Returns False if the partial fetch didn't line up with the cache, in which
+        case the caller should fall back to a full fetch.
+        """
+        cache = self.lattice_cache
+        n_elements = cache['n_elements']
+        if start_index >= n_elements:
+            return True
+        fetched = {}
+        for attr in TWISS_TABLE_ATTRS:
+            values = self.tao.cmd_real("python lat_list -track_only 1@0>>{}:{}|model real:{}".format(start_index, n_elements-1, attr))
+            if attr == 'ele.mat6':
+                values = values.reshape((-1, 6, 6))
+            if len(values) != n_elements - start_index:
+                L.warning("Partial fetch of %s returned %d elements, expected %d.  Falling back to a full table refresh.", attr, len(values), n_elements - start_index)
+                return False
+            fetched[attr] = values
+        for attr, values in fetched.items():
+            cache[attr][start_index:] = values
+        n_rows = cache['n_rows']
+        if start_index < n_rows:
+            downstream = _cumulative_rmats(cache['ele.mat6'][start_index:n_rows])
+            if start_index > 0:
+                downstream = np.matmul(downstream, cache['combined_rmats'][start_index-1])
+            cache['combined_rmats'][start_index:] = downstream
+        return True
+
+    def element_index_for_cmd(self, cmd):
+        """
+        Works out the lowest tracking element index a 'set' command can affect.
+        Commands that set an attribute on a single, known tracking element
+        affect that element and everything downstream of it.  Anything else
+        (wildcards, lord elements, particle_start, globals, etc) conservatively
+        affects the whole lattice, so this returns 0.
+        """
+        if self.lattice_cache is None:
+            return 0
+        match = SET_ELE_RE.match(cmd)
+        if match is None:
+            return 0
+        return self.lattice_cache['element_index'].get(match.group(1).upper(), 0)
+    
+    def wrap_tables(self, twiss_columns, rmat_columns):
+        """
+        Packs the columns from get_twiss_table into timestamped NTTable values.
+        Returns: A (twiss_table, rmat_table) tuple.
+        """
+        timestamp = time.time()
+        return (_wrap_nt_table(self.twiss_table, twiss_columns, timestamp),
+                _wrap_nt_table(self.rmat_table, rmat_columns, timestamp))
     
+    def update_orm(self, start_index=0):
+        """
+        Computes the orbit response matrix from the cumulative RMATs in the
+        lattice cache.  Rows are the x readings of every BPM, then the y
+        readings.  Columns are every XCOR, then every YCOR.  Entries are
+        in m/rad, and zero where the BPM is upstream of the corrector.
+        If start_index is greater than zero, only the rows for BPMs at or
+        downstream of that index are recomputed, since nothing upstream of
+        a change can respond differently.
+        This uses the lattice cache, so it must run on the Tao worker once
+        the event loop is running.
+        Returns: the ORM state dict, with 'matrix', 'rows', and 'columns' keys.
+        """
+        cache = self.lattice_cache
+        if self.orm is None:
+            self.orm = _orm_layout(cache)
+            start_index = 0
+        orm = self.orm
+        bpm_index = orm['bpm_index']
+        rows = bpm_index >= start_index
+        if not rows.any() or len(orm['cor_index']) == 0:
+            return orm
+        combined_rmats = cache['combined_rmats']
+        cor_index = orm['cor_index']
+        #Column kick_column of the transfer matrix from each corrector is
+        #column kick_column of inv(M_j), multiplied by M_i.
+        inverse_rmats = np.linalg.inv(combined_rmats[cor_index])
+        kick_vectors = inverse_rmats[np.arange(len(cor_index)), :, orm['kick_column']]
+        response = np.matmul(combined_rmats[bpm_index[rows]][:, (0, 2), :], kick_vectors.T)
+        upstream = bpm_index[rows, np.newaxis] <= cor_index[np.newaxis, :]
+        response[:, 0, :][upstream] = 0.0
+        response[:, 1, :][upstream] = 0.0
+        n_bpms = len(bpm_index)
+        rows = np.flatnonzero(rows)
+        orm['matrix'][rows] = response[:, 0, :]
+        orm['matrix'][rows + n_bpms] = response[:, 1, :]
+        return orm
+
+    def wrap_orm(self, orm, **kws):
+        """
+        Packs the ORM state from update_orm into an NTNDArray, with the row and
+        column names as attributes.  This is the 'wrap' function of the ORM PVs.
+        """
+        return self.orm_array.wrap(orm['matrix'], attrib={"rows": orm['rows'], "columns": orm['columns'], "units": "m/rad"}, timestamp=time.time())
+
     async def refresh_pva_table(self):
         """
-        This loop continuously checks if the PVAccess table needs to be refreshed,
-        and publishes a new table if it does.  The pva_needs_refresh flag is
-        usually set when a tao command beginning with 'set' occurs.
+        This loop waits for the pva_refresh_event, and publishes new tables
+        when it fires.  broadcast_model_changes sets the event after each
+        recalc, if the pva_needs_refresh flag is set.  The flag is usually set
+        when a tao command beginning with 'set' occurs.
         """
         while True:
+            await self.pva_refresh_event.wait()
+            self.pva_refresh_event.clear()
             if self.pva_needs_refresh:
-                sec, nanosec = divmod(float(time.time()), 1.0)
-                new_twiss_table, new_rmat_table = self.get_twiss_table()
-                new_twiss_table = self.twiss_table.wrap(new_twiss_table)
-                new_twiss_table['timeStamp']['secondsPastEpoch'] = sec
-                new_twiss_table['timeStamp']['nanoseconds'] = nanosec
-                new_rmat_table = self.rmat_table.wrap(new_rmat_table)
-                new_rmat_table['timeStamp']['secondsPastEpoch'] = sec
-                new_rmat_table['timeStamp']['nanoseconds'] = nanosec
+                start_index = self.pva_refresh_index
+                self.pva_needs_refresh = False
+                self.pva_refresh_index = None
+                twiss_columns, rmat_columns = await self.run_tao(self.get_twiss_table, start_index)
+                new_twiss_table, new_rmat_table = self.wrap_tables(twiss_columns, rmat_columns)
                 self.live_twiss_pv.post(new_twiss_table)
                 self.live_rmat_pv.post(new_rmat_table)
-                self.pva_needs_refresh = False
-            await asyncio.sleep(1.0)
+                orm = await self.run_tao(self.update_orm, start_index)
+                self.live_orm_pv.post(orm)
         
     async def add_jitter(self):
         while True:
-            if self.jitter_enabled:
-                x0 = np.random.normal(0.0, 0.12*0.001)
-                y0 = np.random.normal(0.0, 0.12*0.001)
-                self.tao.cmd(f"set particle_start x = {x0}")
-                self.tao.cmd(f"set particle_start y = {y0}")
-                self.recalc_needed = True
-                self.need_zmq_broadcast = True
-            await asyncio.sleep(1.0)
+            await asyncio.sleep(self.jitter_period)
+            try:
+                await self.run_tao_write(self.apply_jitter)
+            except Exception as e:
+                L.warning("JITTER FAILED: %s", e)
+                continue
+            self.recalc_needed = True
+            #Jitter touches elements all along the lattice, so whenever the PVA tables
+            #are refreshed next, they have to be refreshed from the start.
+            self.pva_refresh_index = 0
+            self.need_zmq_broadcast = True
+            self.model_change_event.set()
+
+    def make_jitter_engine(self):
+        """
+        Expands the jitter sources into channels, one per element.  Sources
+        that don't match any element in this lattice are skipped.
+        """
+        engine = jitter.JitterEngine(self.jitter_period)
+        for source in self.jitter_sources:
+            if not source.get('elements'):
+                engine.add_source(source, [None], 1.0)
+                continue
+            relative_to = source.get('relative_to')
+            try:
+                table = self.lattice_query(source['elements'], [relative_to] if relative_to else [], track_only=False, no_slaves=True)
+            except ValueError as e:
+                L.warning("Skipping jitter source %s: %s", source.get('name'), e)
+                continue
+            mask = None
+            if relative_to:
+                #Elements designed with a zero value have nothing to jitter.
+                mask = np.flatnonzero(table[relative_to] != 0.0)
+                table = table[mask]
+                scales = np.abs(table[relative_to])
+            else:
+                scales = 1.0
+            if len(table) > 0:
+                engine.add_source(source, table['name'].tolist(), scales, mask)
+        L.info("Jitter is on, with %d channels.", engine.n_channels)
+        return engine
     
+    def apply_jitter(self):
+        """
+        Applies one tick of jitter.  Every channel is perturbed in one job on
+        the Tao worker, with lattice_calc_on still off, so a tick costs a
+        single recalc and a single generation, however many channels there are.
+        """
+        if self.jitter is None:
+            self.jitter = self.make_jitter_engine()
+        current = [None if group.names == [None] else self.lattice_values(group.source['elements'], [group.source['attribute']], track_only=False, no_slaves=True)[0]
+                   for group in self.jitter.groups]
+        cmds = self.jitter.commands(time.time(), current)
+        for cmd in cmds:
+            self.tao.cmd(cmd)
+        self.generation += 1
+        for cmd in cmds:
+            self.command_log.append(self.generation, cmd, durable=False)
+
+    async def run_tao(self, func, *args):
+        """
+        Runs func(*args) on the Tao worker thread and waits for the result.
+        Tao isn't thread-safe, so every method that touches self.tao must be
+        called through here once the event loop is running.  The worker has a
+        single thread, so calls are executed one at a time, in the order they
+        were submitted.
+        """
+        return await self.loop.run_in_executor(self.tao_executor, func, *args)
+
+    async def run_tao_write(self, func, *args):
+        """
+        Like run_tao, for jobs that change the model.  Reads submitted while
+        it is pending run on the live Tao, after it.
+        """
+        self.pending_writes += 1
+        try:
+            return await self.run_tao(func, *args)
+        finally:
+            self.pending_writes -= 1
+
+    def recalc(self):
+        self.tao.cmd("set global lattice_calc_on = T")
+        self.tao.cmd("set global lattice_calc_on = F")
+        #Results computed before the recalc (twiss, orbits) are stale now,
+        #even though the generation hasn't changed.
+        self.command_cache.clear()
+        L.debug("Command cache: %d hits, %d misses.", self.command_cache.hits, self.command_cache.misses)
+
     async def broadcast_model_changes(self):
         """
-        This loop broadcasts new orbits, twiss parameters, etc. over ZMQ.
+        This loop waits for the model_change_event, then recalculates the
+        lattice and broadcasts new orbits, twiss parameters, etc. over ZMQ.
+        Changes that arrive within coalesce_window of the first one are
+        handled by the same recalc.
         """
         while True:
+            await self.model_change_event.wait()
+            if self.coalesce_window > 0:
+                await asyncio.sleep(self.coalesce_window)
+            self.model_change_event.clear()
             if self.recalc_needed:
-                self.tao.cmd("set global lattice_calc_on = T")
-                self.tao.cmd("set global lattice_calc_on = F")
                 self.recalc_needed = False
+                await self.run_tao(self.recalc)
+                if self.replicas or self.beam_tracker is not None:
+                    self.sync_replicas()
             if self.need_zmq_broadcast:
+                self.need_zmq_broadcast = False
+                #Data is fetched on the Tao thread, but the broadcast socket
+                #is only ever used from the event loop.
                 try:
-                    self.send_orbit()
+                    #get_orbit reuses its buffer, and big arrays are broadcast without
+                    #copying, so the next fetch would overwrite one still being sent.
+                    orbit = (await self.run_tao(self.get_orbit)).copy()
+                    self.send_orbit(orbit)
+                    if self.fast_orbit:
+                        self.last_orbit = orbit.copy()
                 except Exception as e:
                     L.warning("SEND ORBIT FAILED: %s", e)
                 try:
-                    self.send_profiles_data()
+                    prof_data = await self.run_tao(self.get_profiles_data)
+                    self.send_profiles_data(prof_data)
+                    if self.fast_orbit:
+                        self.last_prof_data = prof_data
                 except Exception as e:
                     L.warning("SEND PROF DATA FAILED: %s", e)
                 try:
-                    self.send_und_twiss()
+                    self.send_und_twiss(await self.run_tao(self.get_twiss))
                 except Exception as e:
                     L.warning("SEND UND TWISS FAILED: %s", e)
-
-                self.need_zmq_broadcast = False
-            await asyncio.sleep(0.1)
+                if self.streams:
+                    for topic, values in await self.run_tao(self.get_streams, list(self.streams.values())):
+                        self.publisher.send_array(topic, values, self.generation)
+            if self.pva_needs_refresh:
+                self.pva_refresh_event.set()
     
-    def model_changed(self):
+    def model_changed(self, element_index=0):
+        """
+        Flags the model for a recalc, a PVA table refresh, and a ZMQ broadcast.
+        element_index is the first tracking element affected by the change.
+        The PVA tables are only refreshed from the most upstream changed element.
+        This must run on the event loop thread.  Code on the Tao worker thread
+        schedules it with loop.call_soon_threadsafe.
+        """
         self.recalc_needed = True
+        if self.pva_refresh_index is None or element_index < self.pva_refresh_index:
+            self.pva_refresh_index = element_index
         self.pva_needs_refresh = True
         self.need_zmq_broadcast = True
+        self.model_change_event.set()
     
     def get_orbit(self):
+        """
+        Returns a (3, N) array of x (mm), y (mm), and alive (1 or 0) for every BPM.
+        The array is a buffer that gets reused on the next call.
+        """
         start_time = time.time()
-        #Get X Orbit
-        x_orb_text = self.tao_cmd("show data orbit.x")[3:-2]
-        x_orb = _orbit_array_from_text(x_orb_text)
-        #Get Y Orbit
-        y_orb_text = self.tao_cmd("show data orbit.y")[3:-2]
-        y_orb = _orbit_array_from_text(y_orb_text)
-        #Get e_tot, which we use to see if the single particle beam is dead
-        e_text = self.tao_cmd("show data orbit.e")[3:-2]
-        e = _orbit_array_from_text(e_text)
+        orbit = self.fetch_orbit(BPM_ELEMENTS, with_state=True)
         end_time = time.time()
         L.debug("get_orbit took %f seconds", end_time-start_time)
-        return np.stack((x_orb, y_orb, e))
+        return orbit
 
     def get_prof_orbit(self):
-        #Get X Orbit
-        x_orb_text = self.tao_cmd("show data orbit.profx")[3:-2]
-        x_orb = _orbit_array_from_text(x_orb_text)
-        #Get Y Orbit
-        y_orb_text = self.tao_cmd("show data orbit.profy")[3:-2]
-        y_orb = _orbit_array_from_text(y_orb_text)
-        return np.stack((x_orb, y_orb))
+        """
+        Returns a (2, N) array of x (mm) and y (mm) for every profile monitor.
+        The array is a buffer that gets reused on the next call.
+        """
+        return self.fetch_orbit(PROFILE_ELEMENTS, with_state=False)
+
+    def fetch_orbit(self, elements, with_state):
+        """
+        Fetches the orbit at the given elements as binary arrays with
+        'python lat_list', one call per coordinate, and copies it into a
+        preallocated buffer for those elements.
+        """
+        x = self.tao.cmd_real("python lat_list -track_only 1@0>>{}|model real:orbit.vec.1".format(elements))
+        n_rows = 3 if with_state else 2
+        orbit = self.orbit_buffers.get(elements)
+        if orbit is None or orbit.shape != (n_rows, len(x)):
+            orbit = self.orbit_buffers[elements] = np.empty((n_rows, len(x)))
+        np.multiply(x, 1000.0, out=orbit[0])
+        np.multiply(self.tao.cmd_real("python lat_list -track_only 1@0>>{}|model real:orbit.vec.3".format(elements)), 1000.0, out=orbit[1])
+        if with_state:
+            #A state of 1 means the particle is alive, anything else means it was lost.
+            state = self.tao.cmd_integer("python lat_list -array_out -track_only 1@0>>{}|model orbit.state".format(elements))
+            np.equal(state, 1, out=orbit[2], casting='unsafe')
+        return orbit
     
     def get_twiss(self):
         twiss_text = self.tao_cmd("show lat -no_label_lines -at alpha_a -at beta_a -at alpha_b -at beta_b UNDSTART")
@@ -239,10 +761,10 @@ class ModelService:
             twiss_text = self.tao_cmd("show lat -no_label_lines -at alpha_a -at beta_a -at alpha_b -at beta_b BEGUNDH")
         if "ERROR" in twiss_text[0]:
             twiss_text = self.tao_cmd("show lat -no_label_lines -at alpha_a -at beta_a -at alpha_b -at beta_b BEGUNDS")
-        #format to list of comma separated values
+        #The last four columns are alpha_a, beta_a, alpha_b, beta_b.
         #msg='twiss from get_twiss: {}'.format(twiss_text)
         #L.info(msg)
-        twiss = twiss_text[0].split()
+        twiss = np.array(twiss_text[0].split()[-4:], dtype=np.float64)
         return twiss
 
     def old_get_orbit(self):
@@ -254,103 +776,734 @@ class ModelService:
         y_orb = _orbit_array_from_text(y_orb_text)
         return np.stack((x_orb, y_orb))
    
-    #information broadcast by the model is sent as two separate messages:
-    #metadata message: sent first with 1) tag describing data for services to filter on, 2) type -optional, 3) size -optional
-    #data message: sent either as a python object or a series of bits
+    #information broadcast by the model is sent as multipart messages, see simulacrum.broadcast:
+    #topic frame: a tag describing the data, used by services to filter with zmq.SUBSCRIBE
+    #header frame: fixed size binary header with the model generation, sequence number, dtype, flags and shape
+    #data frame: either the raw bytes of an array, or a pickled python object
     
-    def send_orbit(self):
-        orb = self.get_orbit()
-        metadata = {"tag" : "orbit", "dtype": str(orb.dtype), "shape": orb.shape}
-        self.model_broadcast_socket.send_pyobj(metadata, zmq.SNDMORE)
-        self.model_broadcast_socket.send(orb)
-
-    def send_profiles_data(self):
-        twiss_text = self.tao_cmd("show lat -no_label_lines -at beta_a -at beta_b -at e_tot Monitor::OTR*,Monitor::YAG*")
+    def send_orbit(self, orb, predicted=False):
+        self.publisher.send_array(broadcast.ORBIT, orb, self.generation, flags=broadcast.PREDICTED if predicted else 0)
+
+    def get_profiles_data(self):
+        twiss_text = self.tao_cmd("show lat -no_label_lines -at beta_a -at beta_b -at e_tot {}".format(PROFILE_ELEMENTS))
         prof_beta_x = [float(l.split()[5]) for l in twiss_text]
         prof_beta_y = [float(l.split()[6]) for l in twiss_text]
         prof_e = [float(l.split()[7]) for l in twiss_text]
         prof_names = [l.split()[1] for l in twiss_text]
         prof_orbit = self.get_prof_orbit()
-        prof_data = np.concatenate((prof_orbit, np.array([prof_beta_x, prof_beta_y, prof_e,  prof_names])))
+        return np.concatenate((prof_orbit, np.array([prof_beta_x, prof_beta_y, prof_e,  prof_names])))
 
-        metadata = {"tag" : "prof_data", "dtype": str(prof_data.dtype), "shape": prof_data.shape}
-        self.model_broadcast_socket.send_pyobj(metadata, zmq.SNDMORE)
-        self.model_broadcast_socket.send(prof_data);
+    def send_profiles_data(self, prof_data, predicted=False):
+        self.publisher.send_array(broadcast.PROF_DATA, prof_data, self.generation, flags=broadcast.PREDICTED if predicted else 0)
 
-    def send_particle_positions(self):
-        twiss_text = self.tao_cmd("show lat -no_label_lines -at beta_a -at beta_b -at e_tot Monitor::OTR*,Monitor::YAG*")
-        prof_names = [l.split()[1] for l in twiss_text]
-        positions_all = {}
-        for screen in prof_names:
-            positions = self.get_particle_positions(screen);
-            if not positions:
-                continue
-            positions_all[screen] = [[float(position.split()[1]), float(position.split()[3])] for position in positions]
-        metadata = {"tag": "part_positions"}
-        self.model_broadcast_socket.send_pyobj(metadata, zmq.SNDMORE)
-        self.model_broadcast_socket.send_pyobj(positions_all)
-
-    def get_particle_positions(self, screen):
-        L.debug("Getting particle positions")
-        cmd = "show particle -all -ele {screen}".format(screen=screen)
-        results = self.tao_cmd(cmd);
-        if(len(results) < 3):
-            return False
-        return results[2:]
-
-    def send_und_twiss(self):
-        twiss = self.get_twiss()
-        metadata = {"tag": "und_twiss"}
-        self.model_broadcast_socket.send_pyobj(metadata, zmq.SNDMORE)
-        self.model_broadcast_socket.send_pyobj(twiss)
+    def send_particle_positions(self, positions, generation):
+        """
+        Sends the particle coordinates at each screen as a separate message,
+        with the screen's element name in an extra frame.
+        """
+        for screen, coordinates in positions.items():
+            self.publisher.send_array(broadcast.PART_POSITIONS, coordinates, generation, extra_frames=[screen.encode()])
+
+    def send_und_twiss(self, twiss):
+        self.publisher.send_array(broadcast.UND_TWISS, twiss, self.generation)
+
+    def lattice_query(self, elements, attributes, track_only=True, no_slaves=False):
+        """
+        Fetches several attributes of a group of elements as binary arrays,
+        with one 'python lat_list' call per attribute, instead of formatting
+        and parsing a 'show lat' table.
+        attributes are 'python lat_list' attributes, like 'ele.a.beta' or
+        'orbit.vec.1'.  Plain element attributes, like 'b1_gradient', are
+        read as 'ele.b1_gradient'.
+        Returns: a structured array with a 'name' field, and a float64 field
+        for each attribute, named exactly as the attribute was given.
+        """
+        query = _lat_list_query(elements, track_only, no_slaves)
+        name_lines = self.tao.cmd("{} ele.name".format(query))
+        if any("ERROR" in line for line in name_lines):
+            raise ValueError("Lattice query failed: {}".format("\n".join(name_lines)))
+        names = [name.strip() for line in name_lines for name in line.split(";") if name.strip()]
+        dtype = np.dtype([('name', 'U{}'.format(max((len(name) for name in names), default=1)))] + [(attr, np.float64) for attr in attributes])
+        table = np.empty(len(names), dtype=dtype)
+        table['name'] = names
+        values = self.lattice_values(elements, attributes, track_only, no_slaves) if attributes else np.empty((0, len(names)))
+        if values.shape[1] != len(names):
+            raise ValueError("Lattice query returned {} values for {} elements.".format(values.shape[1], len(names)))
+        for attr, column in zip(attributes, values):
+            table[attr] = column
+        return table
+
+    def lattice_values(self, elements, attributes, track_only=True, no_slaves=False):
+        """
+        Like lattice_query, without the element names.
+        Returns: an (n_attributes, n_elements) float64 array.
+        """
+        query = _lat_list_query(elements, track_only, no_slaves)
+        columns = [self.tao.cmd_real("{} real:{}".format(query, attr if "." in attr else "ele." + attr)) for attr in attributes]
+        if any(len(column) != len(columns[0]) for column in columns):
+            raise ValueError("Lattice query for {} returned columns of different lengths.".format(elements))
+        return np.array(columns, dtype=np.float64).reshape(len(attributes), -1)
+
+    async def register_stream(self, query):
+        """
+        Registers a client's lattice query as a broadcast stream.  Every
+        registered query is evaluated once per model generation, and its
+        values are broadcast on the stream's topic as an (n_attributes,
+        n_elements) array.  Identical queries from different clients share
+        one stream, so each extra subscriber of a stream costs nothing.
+        query is a dict with 'elements', 'attributes', and optionally
+        'track_only' and 'no_slaves', like the lat_query command.
+        Returns: a dict with the stream's 'topic', and the 'names' of the
+        elements, in the order of the broadcast columns.
+        """
+        key = (query['elements'], tuple(query['attributes']), query.get('track_only', True), query.get('no_slaves', False))
+        stream = self.streams.get(key)
+        if stream is None:
+            #Runs the query once, which checks it, and gives us the element names.
+            table = await self.run_tao(self.lattice_query, *key)
+            stream = self.streams.setdefault(key, {'topic': broadcast.STREAM_PREFIX + hashlib.sha1(repr(key).encode()).hexdigest()[:16].encode('ascii'),
+                                                   'query': key, 'names': table['name'].tolist(), 'subscribers': 0})
+            L.info("Registered stream %s: %s", stream['topic'], key)
+        stream['subscribers'] += 1
+        #Broadcast right away, so the new subscriber doesn't wait for the next model change.
+        self.need_zmq_broadcast = True
+        self.model_change_event.set()
+        return {'topic': stream['topic'], 'names': stream['names'], 'attributes': list(key[1])}
+
+    def unregister_stream(self, topic):
+        """
+        Removes one subscriber from the stream with the given topic.  The stream
+        stops being broadcast once it has no subscribers left.
+        """
+        for key, stream in self.streams.items():
+            if stream['topic'] == topic:
+                stream['subscribers'] -= 1
+                if stream['subscribers'] <= 0:
+                    del self.streams[key]
+                    L.info("Unregistered stream %s.", topic)
+                return
+        raise KeyError("Unknown stream: {}".format(topic))
+
+    def get_streams(self, streams):
+        """
+        Evaluates the queries of a list of streams.
+        Returns: a list of (topic, values) tuples.  Streams whose query fails
+        are logged and left out.
+        """
+        results = []
+        for stream in streams:
+            try:
+                results.append((stream['topic'], self.lattice_values(*stream['query'])))
+            except Exception as e:
+                L.warning("SEND STREAM %s FAILED: %s", stream['topic'], e)
+        return results
     
     def tao_cmd(self, cmd):
         if cmd.startswith("exit"):
             return "Please stop trying to exit the model service's Tao, you jerk!"
+        read_only = is_read_only(cmd)
+        if read_only:
+            generation = self.generation
+            cached = self.command_cache.get(generation, cmd)
+            if cached is not None:
+                return cached
+        kick = self.fast_kick(cmd) if self.fast_orbit else None
         result = self.tao.cmd(cmd)
+        if kick is not None and not any("ERROR" in line for line in result):
+            self.publish_predicted_orbits([kick])
+        if read_only:
+            self.command_cache.put(generation, cmd, result)
+            if generation == 0 and self.use_startup_cache and cmd not in self.startup_results:
+                self.startup_results[cmd] = result
+                self.loop.call_soon_threadsafe(self.startup_results_changed)
+        else:
+            #We can't tell what other commands might change, so anything that
+            #isn't known to be read-only starts a new generation, which
+            #invalidates the command cache.  Only lattice settings are logged
+            #for the replicas, scans and journal to replay.
+            self.generation += 1
+            if TRANSACTION_CMD_RE.match(cmd) and not any("ERROR" in line for line in result):
+                self.command_log.append(self.generation, cmd)
         if cmd.startswith("set"):
-            self.model_changed()
+            self.loop.call_soon_threadsafe(self.model_changed, self.element_index_for_cmd(cmd))
         return result
+
+    def apply_transaction(self, cmds):
+        """
+        Applies a group of 'set' commands as a single change to the model.
+        The lattice is copied to Tao's base lattice first.  If any command
+        fails, the model lattice is restored from that copy, and nothing is
+        changed.  Otherwise, there is one generation bump and one model_changed
+        for the whole group, so it gets a single recalc and broadcast.
+        Returns: a list with the result of each command.
+        """
+        for cmd in cmds:
+            if not TRANSACTION_CMD_RE.match(cmd):
+                raise TransactionError("Only 'set ele' and 'set particle_start' commands are allowed in a transaction, got: {}".format(cmd))
+        if not cmds:
+            return []
+        self.tao.cmd("set lattice base = model")
+        results = []
+        kicks = []
+        for cmd in cmds:
+            kick = self.fast_kick(cmd) if self.fast_orbit else None
+            if kick is not None:
+                kicks.append(kick)
+            try:
+                result = self.tao.cmd(cmd)
+            except Exception as e:
+                result = [str(e)]
+            if any("ERROR" in line for line in result):
+                self.tao.cmd("set lattice model = base")
+                raise TransactionError("Transaction aborted, '{}' failed: {}".format(cmd, "\n".join(result)))
+            results.append(result)
+        self.generation += 1
+        for cmd in cmds:
+            self.command_log.append(self.generation, cmd)
+        if kicks:
+            self.publish_predicted_orbits(kicks)
+        element_index = min(self.element_index_for_cmd(cmd) for cmd in cmds)
+        self.loop.call_soon_threadsafe(self.model_changed, element_index)
+        return results
+
+    def fast_kick(self, cmd):
+        """
+        If cmd sets the kick of a single tracking element, returns an
+        (element index, plane, change in kick in radians) tuple for it.
+        This has to be called before cmd runs, since it reads the old kick from Tao.
+        Returns None for every other command.
+        """
+        match = SET_KICK_RE.match(cmd)
+        if match is None or self.lattice_cache is None:
+            return None
+        element, attr, value = match.groups()
+        index = self.lattice_cache['element_index'].get(element.upper())
+        try:
+            value = float(value)
+        except ValueError:
+            return None
+        if index is None or index >= self.lattice_cache['n_rows']:
+            return None
+        attr = attr.lower()
+        old_value = self.tao.cmd_real("python lat_list -track_only 1@0>>{}|model real:ele.{}".format(index, attr))[0]
+        delta = value - old_value
+        if attr.startswith("bl_"):
+            p0c = self.tao.cmd_real("python lat_list -track_only 1@0>>{}|model real:ele.p0c".format(index))[0]
+            delta = delta * C_LIGHT * REFERENCE_CHARGE / p0c
+        plane = 'x' if attr.endswith("hkick") else 'y'
+        return index, plane, delta
+
+    def orbit_response(self, elements, kicks):
+        """
+        Predicts the change in orbit at elements from a list of fast_kick tuples,
+        using the cumulative RMATs in the lattice cache.  The transfer matrix from
+        a corrector at index j to an element at index i is M_i @ inv(M_j).
+        Returns: a (2, N) array of x and y changes, in meters.
+        """
+        observers = self.observer_indices.get(elements)
+        if observers is None:
+            observers = np.asarray(self.tao.cmd_integer("python lat_list -array_out -track_only 1@0>>{}|model ele.ix_ele".format(elements)), dtype=np.intp)
+            self.observer_indices[elements] = observers
+        combined_rmats = self.lattice_cache['combined_rmats']
+        delta = np.zeros((2, len(observers)))
+        for index, plane, kick in kicks:
+            downstream = (observers > index) & (observers < len(combined_rmats))
+            transfer = np.matmul(combined_rmats[observers[downstream]], np.linalg.inv(combined_rmats[index]))
+            column = 1 if plane == 'x' else 3
+            delta[0, downstream] += transfer[:, 0, column] * kick
+            delta[1, downstream] += transfer[:, 2, column] * kick
+        return delta
+
+    def publish_predicted_orbits(self, kicks):
+        #Runs on the Tao worker.  The predictions are broadcast from the event loop.
+        try:
+            deltas = {elements: self.orbit_response(elements, kicks) for elements in (BPM_ELEMENTS, PROFILE_ELEMENTS)}
+        except Exception as e:
+            L.warning("Orbit prediction failed: %s", e)
+            return
+        self.loop.call_soon_threadsafe(self.send_predicted_orbits, deltas)
+
+    def send_predicted_orbits(self, deltas):
+        """
+        Adds predicted orbit changes to the last broadcast orbits, and
+        broadcasts the result with the PREDICTED header flag.  The full recalc
+        that follows every change broadcasts the real orbit, which replaces
+        the prediction.
+        """
+        if self.last_orbit is not None and self.last_orbit.shape[1] == deltas[BPM_ELEMENTS].shape[1]:
+            self.last_orbit[0:2] += deltas[BPM_ELEMENTS] * 1000.0
+            self.send_orbit(self.last_orbit.copy(), predicted=True)
+        if self.last_prof_data is not None and self.last_prof_data.shape[1] == deltas[PROFILE_ELEMENTS].shape[1]:
+            prof_orbit = self.last_prof_data[0:2].astype(np.float64) + deltas[PROFILE_ELEMENTS] * 1000.0
+            self.last_prof_data = np.concatenate((prof_orbit, self.last_prof_data[2:]))
+            self.send_profiles_data(self.last_prof_data, predicted=True)
+
+    def begin_transaction(self):
+        now = time.time()
+        for txn_id, (start_time, _) in list(self.transactions.items()):
+            if now - start_time > TRANSACTION_TIMEOUT:
+                L.warning("Discarding transaction %d, it was never committed.", txn_id)
+                del self.transactions[txn_id]
+        txn_id = next(self.transaction_ids)
+        self.transactions[txn_id] = (now, [])
+        return txn_id
+
+    def cached_lattice_query(self, key):
+        """
+        Runs lattice_query for a lat_query_key, through the command cache.
+        Tables for the design lattice go in the startup cache, like the
+        results of read-only commands do in tao_cmd.
+        """
+        generation = self.generation
+        table = self.command_cache.get(generation, key)
+        if table is not None:
+            return table
+        _, elements, attributes, track_only, no_slaves = key
+        table = self.lattice_query(elements, list(attributes), track_only, no_slaves)
+        self.command_cache.put(generation, key, table)
+        if generation == 0 and self.use_startup_cache and key not in self.startup_results:
+            self.startup_results[key] = table
+            self.loop.call_soon_threadsafe(self.startup_results_changed)
+        return table
+
+    def cached_result(self, cmd):
+        """
+        Returns the cached result of a read-only command for the current
+        generation, or None.  This is safe to call from the event loop, so
+        cache hits don't have to wait for the Tao worker.
+        """
+        if not is_read_only(cmd) or self.pending_writes:
+            return None
+        return self.command_cache.get(self.generation, cmd)
     
-    def tao_batch(self, cmds):
+    async def tao_batch(self, cmds):
+        """
+        Runs a list of Tao commands in order.  Each command is a separate job on
+        the Tao worker, so requests from other clients can be served in
+        between the commands of a long batch.
+        """
         L.info("Starting command batch.")
-        results = [self.tao_cmd(cmd) for cmd in cmds]
+        results = []
+        for cmd in cmds:
+            results.append(await self.run_tao_cmd(cmd))
         L.info("Batch complete.")
         return results
     
+    async def run_tao_cmd(self, cmd):
+        """
+        Runs a Tao command for a client.  Read-only commands are answered from
+        the command cache if possible, and otherwise by the read replica with
+        the fewest outstanding requests, as long as the replicas are synced
+        to the current generation, and no change to the model is pending.
+        Everything else runs on the live Tao.
+        """
+        if not is_read_only(cmd):
+            return await self.run_tao_write(self.tao_cmd, cmd)
+        result = self.cached_result(cmd)
+        if result is not None:
+            return result
+        generation = self.generation
+        ready_replicas = [replica for replica in self.replicas if replica['ready']]
+        if not ready_replicas or self.replica_generation != generation or self.pending_writes:
+            return await self.run_tao(self.tao_cmd, cmd)
+        replica = min(ready_replicas, key=lambda replica: replica['outstanding'])
+        replica['outstanding'] += 1
+        try:
+            result = await self.submit_to_pool(replica['pool'], scan_worker.read, cmd)
+        finally:
+            replica['outstanding'] -= 1
+        self.command_cache.put(generation, cmd, result)
+        return result
+
+    def sync_replicas(self):
+        """
+        Sends every command logged since the last sync to the read replicas,
+        and to the beam tracker.  This runs after each recalc.  The generation
+        is read before the commands are collected, so a replica is never
+        labelled with a newer generation than it has.
+        """
+        generation = self.generation
+        cmds = self.command_log.take_pending()
+        for replica in self.replicas:
+            self.submit_to_pool(replica['pool'], scan_worker.sync, cmds).add_done_callback(_log_replica_error)
+        self.replica_generation = generation
+        if self.beam_tracker is not None:
+            self.beam_tracker['cmds'].extend(cmds)
+            self.beam_tracker['generation'] = generation
+            self.track_beam()
+
+    def track_beam(self):
+        """
+        Tracks the beam through the lattice of the latest synced generation,
+        and broadcasts the particle coordinates at every screen.  Beam
+        tracking is slower than a recalc, so only one job runs at a time.
+        Commands synced while it runs are saved up for the next one, and any
+        generations in between are skipped.
+        """
+        tracker = self.beam_tracker
+        if tracker['busy'] or tracker['tracked_generation'] == tracker['generation']:
+            return
+        cmds, tracker['cmds'] = tracker['cmds'], []
+        generation = tracker['generation']
+        tracker['busy'] = True
+        future = self.submit_to_pool(tracker['pool'], scan_worker.track_beam, cmds, PROFILE_ELEMENTS)
+        future.add_done_callback(lambda future: self.beam_tracked(future, generation))
+
+    def beam_tracked(self, future, generation):
+        tracker = self.beam_tracker
+        tracker['busy'] = False
+        tracker['tracked_generation'] = generation
+        try:
+            self.send_particle_positions(future.result(), generation)
+        except Exception as e:
+            L.warning("BEAM TRACKING FAILED: %s", e)
+        self.track_beam()
+
+    def get_scan_pool(self):
+        if self.scan_pool is None:
+            L.info("Starting %d scan workers.", self.scan_workers)
+            self.scan_pool = multiprocessing.get_context("spawn").Pool(self.scan_workers, initializer=scan_worker.init_worker, initargs=(self.init_file,))
+        return self.scan_pool
+
+    def submit_scan_point(self, base_cmds, cmds, observables):
+        return self.submit_to_pool(self.get_scan_pool(), scan_worker.run_point, base_cmds, cmds, observables)
+
+    def submit_to_pool(self, pool, func, *args):
+        """
+        Runs func(*args) in a multiprocessing pool.
+        Returns: an asyncio future for the result.
+        """
+        future = self.loop.create_future()
+        pool.apply_async(func, args,
+                         callback=lambda result: self.loop.call_soon_threadsafe(_set_future_result, future, result),
+                         error_callback=lambda e: self.loop.call_soon_threadsafe(_set_future_exception, future, e))
+        return future
+
+    async def scan(self, scan, send_partial=None):
+        """
+        Evaluates a grid of settings on the scan workers, in parallel.
+        scan is a dict with these keys:
+            'base': optional list of 'set' commands applied to the design lattice before every point,
+                    or 'live' to start every point from the current live model.
+            'settings': list of 'set' command templates, like "set ele QE01 b1_gradient = {}".
+            'values': (n_points, n_settings) array.  Point i formats settings[k] with values[i][k].
+            'observables': list of (element selector, attribute) pairs, like ("BPM*", "orbit.vec.1").
+        If send_partial is given, it is called with a 'partial' reply as each point finishes.
+        Returns: a dict with the 'observables' and 'values', a 'results' list with
+        an (n_points, n_elements) array for each observable, and an 'errors'
+        dict of point index -> message.  Rows for failed points are NaN.
+        """
+        if scan.get('base') == 'live':
+            #The live model's own log is trusted, only the caller's commands are checked.
+            _, base_cmds = self.command_log.commands()
+            checked_base = []
+        else:
+            base_cmds = checked_base = list(scan.get('base', []))
+        settings = list(scan['settings'])
+        values = np.asarray(scan['values'], dtype=np.float64).reshape(-1, len(settings))
+        observables = [tuple(observable) for observable in scan['observables']]
+        points = [[setting.format(value) for setting, value in zip(settings, row)] for row in values]
+        for cmd in itertools.chain(checked_base, *points):
+            if not TRANSACTION_CMD_RE.match(cmd):
+                raise ValueError("Only 'set ele' and 'set particle_start' commands are allowed in a scan, got: {}".format(cmd))
+        start_time = time.time()
+        futures = {self.submit_scan_point(base_cmds, cmds, observables): i for i, cmds in enumerate(points)}
+        point_results = [None]*len(points)
+        errors = {}
+        pending = set(futures)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                i = futures[future]
+                try:
+                    point_results[i] = future.result()
+                except Exception as e:
+                    errors[i] = str(e)
+                if send_partial is not None:
+                    await send_partial({'status': 'partial', 'index': i, 'result': point_results[i], 'err': errors.get(i)})
+        L.info("Scan of %d points took %f seconds.", len(points), time.time() - start_time)
+        results = []
+        for k in range(len(observables)):
+            n_elements = max((len(r[k]) for r in point_results if r is not None), default=0)
+            result = np.full((len(points), n_elements), np.nan)
+            for i, r in enumerate(point_results):
+                if r is not None:
+                    result[i] = r[k]
+            results.append(result)
+        return {'observables': observables, 'values': values, 'results': results, 'errors': errors}
+
+    async def whatif(self, whatif):
+        """
+        Evaluates what the model would look like with a set of changes, without
+        changing the live model.  The changes are applied in a scan worker, on
+        top of the live model rebuilt from the durable commands in the command
+        log, so this doesn't cause any recalc, PVA refresh, or broadcast of the
+        live model.  Jitter is left out, so the worker's base lattice doesn't
+        have to be rebuilt on every jitter tick.
+        whatif is a dict with these keys:
+            'cmds': list of 'set ele' and 'set particle_start' commands.
+            'observables': list of (element selector, attribute) pairs, like ("BPM*", "orbit.vec.1").
+        Returns: a dict with the live 'generation' the changes were applied to,
+        and a 'results' list with a numpy array for each observable.
+        """
+        cmds = list(whatif['cmds'])
+        for cmd in cmds:
+            if not TRANSACTION_CMD_RE.match(cmd):
+                raise ValueError("Only 'set ele' and 'set particle_start' commands are allowed in a what-if, got: {}".format(cmd))
+        observables = [tuple(observable) for observable in whatif['observables']]
+        generation, live_cmds = self.command_log.commands(durable_only=True)
+        results = await self.submit_scan_point(live_cmds, cmds, observables)
+        return {'generation': generation, 'results': results}
+
     async def recv(self):
-        s = self.ctx.socket(zmq.REP)
+        """
+        Serves commands on a ROUTER socket.  Plain REQ clients work as before,
+        and DEALER clients can pipeline many requests at once by adding an 'id'
+        key to each message, which is echoed back in the reply.  Each request is
+        handled in its own task, so quick requests (echo, broadcast requests)
+        are answered right away, even while a long batch is still running.
+        Tao commands still execute one at a time, on the Tao worker thread.
+        """
+        s = self.ctx.socket(zmq.ROUTER)
         s.bind("tcp://*:{}".format(os.environ.get('MODEL_PORT', "12312")))
         while True:
-            p = await s.recv_pyobj()
-            msg = "Got a message: {}".format(p)
-            L.debug(msg)
-            if p['cmd'] == 'tao':
-                try:
-                    retval = self.tao_cmd(p['val'])
-                    await s.send_pyobj({'status': 'ok', 'result': retval})
-                except Exception as e:
-                    await s.send_pyobj({'status': 'fail', 'err': e})
-            elif p['cmd'] == 'send_orbit':
-                self.model_changed() #Sets the flag that will cause an orbit broadcast
-                await s.send_pyobj({'status': 'ok'})
-            elif p['cmd'] == 'echo':
-                    await s.send_pyobj({'status': 'ok', 'result': p['val']})
-            elif p['cmd'] == 'send_profiles_twiss':
-                self.model_changed() #Sets the flag that will cause a prof broadcast
-                #self.send_profiles_twiss()
-                #self.send_prof_orbit()
-                await s.send_pyobj({'status': 'ok'})
-            elif p['cmd'] == 'send_und_twiss':
-                self.model_changed() #Sets the flag that will cause an und twiss broadcast
-                #self.send_und_twiss()
-                await s.send_pyobj({'status': 'ok'})
-            elif p['cmd'] == 'tao_batch':
-                try:
-                    results = self.tao_batch(p['val'])
-                    await s.send_pyobj({'status': 'ok', 'result': results})
-                except Exception as e:
-                    await s.send_pyobj({'status': 'fail', 'err': e})
+            frames = await s.recv_multipart()
+            #Everything before the last frame is the routing envelope: the client
+            #identity, plus an empty delimiter frame for REQ clients.
+            envelope, payload = frames[:-1], frames[-1]
+            self.loop.create_task(self.handle_request(s, envelope, payload))
+
+    async def handle_request(self, s, envelope, payload):
+        try:
+            p = pickle.loads(payload)
+        except Exception as e:
+            L.warning("Could not decode request: %s", e)
+            await s.send_multipart(envelope + [pickle.dumps({'status': 'fail', 'err': e})])
+            return
+        msg = "Got a message: {}".format(p)
+        L.debug(msg)
+        async def send_reply(reply):
+            if isinstance(p, dict) and 'id' in p:
+                reply['id'] = p['id']
+            #Replies with binary data (see lat_query) send it in frames after
+            #the pickled reply, straight from the array buffers.
+            frames = reply.pop('frames', [])
+            await s.send_multipart(envelope + [pickle.dumps(reply)] + frames, copy=False)
+        #Commands that stream results send 'partial' replies before the final one.
+        try:
+            reply = await self.handle_command(p, send_partial=send_reply)
+        except Exception as e:
+            #Malformed requests (no 'cmd', no 'val', not a dict) still get a reply,
+            #or a REQ client would wait for one forever.
+            L.warning("Could not handle request %s: %s", p, e)
+            reply = {'status': 'fail', 'err': e}
+        await send_reply(reply)
+
+    async def handle_command(self, p, send_partial=None):
+        """
+        Executes a single request, and returns the reply dict.
+        Transactions apply a group of 'set' commands with one recalc at the end:
+            {'cmd': 'begin'} replies with a transaction id in 'result'.
+            {'cmd': 'tao', 'val': 'set ele ...', 'txn': id} queues a command.
+            {'cmd': 'commit', 'txn': id} applies every queued command, or none of them if one fails.
+            {'cmd': 'abort', 'txn': id} discards the queued commands.
+            {'cmd': 'transaction', 'val': [...]} does all of that in one request.
+        Scans run on separate Tao processes, and never change the live model.  See scan.
+            {'cmd': 'scan', 'val': {...}, 'stream': True} also sends a 'partial'
+            reply as each point finishes.  Only DEALER clients can receive those.
+            {'cmd': 'whatif', 'val': {...}} evaluates one change set on top of the live model.  See whatif.
+        {'cmd': 'lat_query', 'val': {'elements': 'Quadrupole::*', 'attributes': ['l', 'b1_gradient']}}
+            replies with the structured array from lattice_query in a second frame, and its
+            'dtype' and 'shape' in 'result'.  'track_only' and 'no_slaves' are optional.
+            Use simulacrum.model_client.lat_query to send it and decode the reply.
+        {'cmd': 'register_stream', 'val': {...}} registers the same kind of query as a broadcast
+            stream, evaluated once per model generation.  See register_stream.
+        {'cmd': 'unregister_stream', 'val': topic} drops a subscription to a stream.
+        {'cmd': 'batch', 'val': [request, ...]} executes several requests in order, and replies
+            with their replies in 'result', each with its request's 'id'.  Requests with binary
+            or streamed replies can't be batched.  simulacrum.ModelClient sends these.
+        """
+        if p['cmd'] == 'tao' and 'txn' in p:
+            #Queue the command until the transaction is committed.
+            if p['txn'] not in self.transactions:
+                return {'status': 'fail', 'err': TransactionError("Unknown transaction: {}".format(p['txn']))}
+            if not TRANSACTION_CMD_RE.match(p['val']):
+                del self.transactions[p['txn']]
+                return {'status': 'fail', 'err': TransactionError("Transaction aborted, only 'set ele' and 'set particle_start' commands are allowed, got: {}".format(p['val']))}
+            self.transactions[p['txn']][1].append(p['val'])
+            return {'status': 'ok', 'result': None}
+        elif p['cmd'] == 'tao':
+            try:
+                retval = await self.run_tao_cmd(p['val'])
+                return {'status': 'ok', 'result': retval}
+            except Exception as e:
+                return {'status': 'fail', 'err': e}
+        elif p['cmd'] == 'send_orbit':
+            self.model_changed() #Sets the flag that will cause an orbit broadcast
+            return {'status': 'ok'}
+        elif p['cmd'] == 'echo':
+            return {'status': 'ok', 'result': p['val']}
+        elif p['cmd'] == 'send_profiles_twiss':
+            self.model_changed() #Sets the flag that will cause a prof broadcast
+            return {'status': 'ok'}
+        elif p['cmd'] == 'send_und_twiss':
+            self.model_changed() #Sets the flag that will cause an und twiss broadcast
+            return {'status': 'ok'}
+        elif p['cmd'] == 'tao_batch':
+            try:
+                results = await self.tao_batch(p['val'])
+                return {'status': 'ok', 'result': results}
+            except Exception as e:
+                return {'status': 'fail', 'err': e}
+        elif p['cmd'] == 'begin':
+            return {'status': 'ok', 'result': self.begin_transaction()}
+        elif p['cmd'] == 'commit':
+            transaction = self.transactions.pop(p.get('txn'), None)
+            if transaction is None:
+                return {'status': 'fail', 'err': TransactionError("Unknown transaction: {}".format(p.get('txn')))}
+            try:
+                results = await self.run_tao_write(self.apply_transaction, transaction[1])
+                return {'status': 'ok', 'result': results}
+            except Exception as e:
+                return {'status': 'fail', 'err': e}
+        elif p['cmd'] == 'abort':
+            if self.transactions.pop(p.get('txn'), None) is None:
+                return {'status': 'fail', 'err': TransactionError("Unknown transaction: {}".format(p.get('txn')))}
+            return {'status': 'ok'}
+        elif p['cmd'] == 'transaction':
+            #A whole transaction in one request: begin, queue p['val'], and commit.
+            try:
+                results = await self.run_tao_write(self.apply_transaction, p['val'])
+                return {'status': 'ok', 'result': results}
+            except Exception as e:
+                return {'status': 'fail', 'err': e}
+        elif p['cmd'] == 'whatif':
+            try:
+                results = await self.whatif(p['val'])
+                return {'status': 'ok', 'result': results}
+            except Exception as e:
+                return {'status': 'fail', 'err': e}
+        elif p['cmd'] == 'lat_query':
+            try:
+                key = lat_query_key(p['val'])
+                table = None if self.pending_writes else self.command_cache.get(self.generation, key)
+                if table is None:
+                    table = await self.run_tao(self.cached_lattice_query, key)
+                return {'status': 'ok', 'result': {'dtype': table.dtype.descr, 'shape': table.shape}, 'frames': [table]}
+            except Exception as e:
+                return {'status': 'fail', 'err': e}
+        elif p['cmd'] == 'register_stream':
+            try:
+                return {'status': 'ok', 'result': await self.register_stream(p['val'])}
+            except Exception as e:
+                return {'status': 'fail', 'err': e}
+        elif p['cmd'] == 'unregister_stream':
+            try:
+                self.unregister_stream(p['val'])
+                return {'status': 'ok'}
+            except Exception as e:
+                return {'status': 'fail', 'err': e}
+        elif p['cmd'] == 'batch':
+            replies = []
+            for request in p['val']:
+                if not isinstance(request, dict) or request.get('cmd') in ('batch', 'lat_query', 'scan'):
+                    reply = {'status': 'fail', 'err': ValueError("Can't batch this request: {}".format(request))}
+                else:
+                    try:
+                        reply = await self.handle_command(request)
+                    except Exception as e:
+                        reply = {'status': 'fail', 'err': e}
+                if isinstance(request, dict) and 'id' in request:
+                    reply['id'] = request['id']
+                replies.append(reply)
+            return {'status': 'ok', 'batch': True, 'result': replies}
+        elif p['cmd'] == 'scan':
+            try:
+                results = await self.scan(p['val'], send_partial if p.get('stream') else None)
+                return {'status': 'ok', 'result': results}
+            except Exception as e:
+                return {'status': 'fail', 'err': e}
+        else:
+            return {'status': 'fail', 'err': ValueError("Unknown command: {}".format(p['cmd']))}
+
+def _set_future_result(future, result):
+    if not future.done():
+        future.set_result(result)
+
+def _set_future_exception(future, e):
+    if not future.done():
+        future.set_exception(e)
+
+def _log_replica_error(future):
+    if future.exception() is not None:
+        L.warning("Read replica sync failed: %s", future.exception())
+
+def _orm_layout(cache):
+    """
+    Finds the BPMs and correctors for the orbit response matrix in a lattice
+    cache, and allocates the matrix.
+    """
+    n_rows = cache['n_rows']
+    element_names = cache['element_names']
+    device_names = cache['device_names']
+    patterns = BPM_ELEMENTS.split(",")
+    bpm_index = np.array([i for i, name in enumerate(element_names) if any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)], dtype=np.intp)
+    #Each corrector is placed at its first slice.
+    correctors = {}
+    for i, device_name in enumerate(device_names[:n_rows]):
+        if device_name.startswith((XCOR_PREFIX, YCOR_PREFIX)):
+            correctors.setdefault(device_name, i)
+    xcors = [(i, name) for name, i in correctors.items() if name.startswith(XCOR_PREFIX)]
+    ycors = [(i, name) for name, i in correctors.items() if name.startswith(YCOR_PREFIX)]
+    cor_index = np.array([i for i, _ in xcors + ycors], dtype=np.intp)
+    #XCORs kick px (RMAT column 2), and YCORs kick py (column 4).
+    kick_column = np.array([1]*len(xcors) + [3]*len(ycors), dtype=np.intp)
+    bpm_names = [device_names[i] or element_names[i] for i in bpm_index]
+    return {"bpm_index": bpm_index, "cor_index": cor_index, "kick_column": kick_column,
+            "rows": ["{}:X".format(name) for name in bpm_names] + ["{}:Y".format(name) for name in bpm_names],
+            "columns": [name for _, name in xcors + ycors],
+            "matrix": np.zeros((2*len(bpm_index), len(cor_index)))}
+
+def _lat_list_query(elements, track_only, no_slaves):
+    """
+    Returns: the start of a 'python lat_list' command for elements, without the attribute.
+    """
+    flags = [flag for flag, enabled in (("-track_only", track_only), ("-no_slaves", no_slaves)) if enabled]
+    return "python lat_list {} 1@0>>{}|model".format(" ".join(flags), elements)
+
+def lat_query_key(query):
+    """
+    Returns: the command cache key for the 'val' of a lat_query request.
+    """
+    return ("lat_query", query['elements'], tuple(query['attributes']), bool(query.get('track_only', True)), bool(query.get('no_slaves', False)))
+
+def is_read_only(cmd):
+    return cmd.startswith(READ_ONLY_CMD_PREFIXES) and "-write" not in cmd
+
+def _cumulative_rmats(element_rmats):
+    """
+    Computes the running products M_i @ ... @ M_1 @ M_0 for an (N, 6, 6) stack
+    of element transfer matrices.  This is a log-depth (Hillis-Steele) prefix
+    scan, so every step is a single batched np.matmul over the whole stack
+    rather than N separate 6x6 products in a Python loop.
+    """
+    combined = np.array(element_rmats, dtype=np.float64, copy=True)
+    stride = 1
+    while stride < len(combined):
+        combined[stride:] = np.matmul(combined[stride:], combined[:-stride])
+        stride *= 2
+    return combined
+
+def _wrap_nt_table(nt, columns, timestamp):
+    """
+    Builds an NTTable Value directly from a dict of column arrays.
+    NTTable.wrap wants a list of per-row dicts, which is slow for big tables.
+    """
+    value = Value(nt.type, {"labels": nt.labels, "value": columns})
+    sec, frac = divmod(timestamp, 1.0)
+    value['timeStamp']['secondsPastEpoch'] = int(sec)
+    value['timeStamp']['nanoseconds'] = int(frac*1e9)
+    return value
 
 def _orbit_array_from_text(text):
     return np.array([float(l.split()[5]) for l in text])*1000.0
@@ -390,7 +1543,67 @@ if __name__=="__main__":
     parser.add_argument(
         '--enable-jitter',
         action='store_true',
-        help='Apply jitter on every model update tick (10 Hz).  This will significantly increase CPU usage.'
+        help='Apply jitter to the launch, RF, and magnets on every jitter tick.  Each tick costs one lattice recalc.'
+    )
+    parser.add_argument(
+        '--jitter-rate',
+        type=float,
+        default=1.0,
+        help='Jitter ticks per second.  Zero or less disables jitter.  Default is 1.'
+    )
+    parser.add_argument(
+        '--jitter-config',
+        default=None,
+        help='JSON file with a list of jitter sources, see jitter.py.  Default is jitter.DEFAULT_SOURCES.'
+    )
+    parser.add_argument(
+        '--coalesce-window',
+        type=float,
+        default=0.005,
+        help='Seconds to wait after a model change before recalculating, so bursts of changes share one recalc.  Default is 0.005.'
+    )
+    parser.add_argument(
+        '--command-cache-mb',
+        type=float,
+        default=64.0,
+        help='Memory limit for cached results of read-only Tao commands, in MB.  Default is 64.'
+    )
+    parser.add_argument(
+        '--no-startup-cache',
+        action='store_true',
+        help='Always initialize Tao before serving, and don\'t read or write the startup cache in $SIMULACRUM_CACHE_DIR (default ~/.cache/simulacrum).'
+    )
+    parser.add_argument(
+        '--fast-orbit',
+        action='store_true',
+        help='Broadcast a linear prediction of the orbit right after each corrector kick, before the full lattice recalc.'
+    )
+    parser.add_argument(
+        '--scan-workers',
+        type=int,
+        default=None,
+        help='Number of worker processes for scans, each with its own Tao.  Default is the number of CPUs.'
+    )
+    parser.add_argument(
+        '--read-replicas',
+        type=int,
+        default=0,
+        help='Number of read replica processes, each with its own Tao, for serving read-only commands.  Default is 0.'
+    )
+    parser.add_argument(
+        '--track-beam',
+        action='store_true',
+        help='Track a beam distribution in a separate process after every model change, and broadcast the particles at every screen.'
+    )
+    parser.add_argument(
+        '--fresh',
+        action='store_true',
+        help='Start from the design lattice, and discard the settings saved in the journal by the last run.'
+    )
+    parser.add_argument(
+        '--no-journal',
+        action='store_true',
+        help='Don\'t save settings to the journal in $SIMULACRUM_CACHE_DIR, or restore them at startup.'
     )
     parser.add_argument(
         '--plot',
@@ -399,7 +1612,15 @@ if __name__=="__main__":
     )
     model_service_args = parser.parse_args()
     tao_init_file = find_model(model_service_args.model_name)
-    serv = ModelService(init_file=tao_init_file, name=model_service_args.model_name.upper(), enable_jitter=model_service_args.enable_jitter, 
-                        plot=model_service_args.plot)
+    serv = ModelService(init_file=tao_init_file, name=model_service_args.model_name.upper(), enable_jitter=model_service_args.enable_jitter and model_service_args.jitter_rate > 0, 
+                        plot=model_service_args.plot, coalesce_window=model_service_args.coalesce_window,
+                        command_cache_bytes=int(model_service_args.command_cache_mb*1024*1024),
+                        use_startup_cache=not model_service_args.no_startup_cache,
+                        fast_orbit=model_service_args.fast_orbit, scan_workers=model_service_args.scan_workers,
+                        read_replicas=model_service_args.read_replicas,
+                        journal=not model_service_args.no_journal, fresh=model_service_args.fresh,
+                        jitter_sources=jitter.load_sources(model_service_args.jitter_config) if model_service_args.jitter_config else None,
+                        jitter_period=1.0/model_service_args.jitter_rate if model_service_args.jitter_rate > 0 else 1.0,
+                        track_beam=model_service_args.track_beam)
     serv.start()
 
@@ -0,0 +1,91 @@
+"""
+Functions that run in the scan worker, read replica, and beam tracker
+processes.  Each process has its own Tao, loaded from the same init file as
+the live model, so scan points never touch the live model's state.  See
+ModelService.scan, ModelService.run_tao_cmd, and ModelService.track_beam.
+"""
+import os
+import numpy as np
+import pytao
+
+#The Tao instance for this worker process, created by init_worker.
+_tao = None
+#The base commands that the worker's base lattice was built from.
+_base_cmds = None
+
+def init_worker(init_file):
+    global _tao
+    _tao = pytao.Tao(so_lib=os.environ.get('TAO_LIB', ''))
+    _tao.init("-noplot -init {init_file}".format(init_file=init_file))
+    _tao.cmd("set global lattice_calc_on = F")
+    _tao.cmd('set global var_out_file = " "')
+
+def run_point(base_cmds, cmds, observables):
+    """
+    Evaluates a single scan point: the design lattice, plus base_cmds, plus cmds.
+    The lattice with base_cmds applied is kept in Tao's base lattice, so
+    consecutive points with the same base only pay for their own commands.
+    observables is a list of (element selector, lattice attribute) pairs, like
+    ("BPM*", "orbit.vec.1").
+    Returns: a list with a numpy array for each observable.
+    """
+    global _base_cmds
+    if base_cmds != _base_cmds:
+        _base_cmds = None
+        _tao.cmd("set lattice model = design")
+        for cmd in base_cmds:
+            _run(cmd)
+        _tao.cmd("set lattice base = model")
+        _base_cmds = list(base_cmds)
+    else:
+        _tao.cmd("set lattice model = base")
+    for cmd in cmds:
+        _run(cmd)
+    _tao.cmd("set global lattice_calc_on = T")
+    _tao.cmd("set global lattice_calc_on = F")
+    return [_tao.cmd_real("python lat_list -track_only 1@0>>{}|model real:{}".format(elements, attr)) for elements, attr in observables]
+
+def _run(cmd):
+    result = _tao.cmd(cmd)
+    if any("ERROR" in line for line in result):
+        raise ValueError("'{}' failed: {}".format(cmd, "\n".join(result)))
+
+def sync(cmds):
+    """
+    Applies commands from the live model's command log, and recalculates.
+    Read replicas run this after every recalc of the live model, so they
+    follow it.  Commands already succeeded on the live model, so errors are
+    not checked here.
+    """
+    for cmd in cmds:
+        _tao.cmd(cmd)
+    _tao.cmd("set global lattice_calc_on = T")
+    _tao.cmd("set global lattice_calc_on = F")
+
+def read(cmd):
+    return _tao.cmd(cmd)
+
+def init_beam_worker(init_file, screens):
+    """
+    Sets up a Tao that tracks a beam on every recalc, and keeps the beam at
+    the elements matching screens.
+    """
+    init_worker(init_file)
+    _tao.cmd("set global track_type = beam")
+    _tao.cmd("set beam saved_at = {}".format(screens))
+
+def track_beam(cmds, screens):
+    """
+    Applies commands from the live model's command log, and tracks the beam.
+    Returns: a dict of element name -> (n_particles, 2) array of the x and y
+    (m) of every particle still alive at that element.
+    """
+    sync(cmds)
+    positions = {}
+    for name in _tao.cmd("python lat_list -track_only 1@0>>{}|model ele.name".format(screens)):
+        name = name.strip()
+        x = _tao.cmd_real("python bunch1 {}|model 1 x".format(name))
+        y = _tao.cmd_real("python bunch1 {}|model 1 y".format(name))
+        alive = _tao.cmd_integer("python bunch1 {}|model 1 state".format(name)) == 1
+        positions[name] = np.stack((x[alive], y[alive]), axis=1)
+    return positions
@@ -0,0 +1,93 @@
+"""
+A disk cache of everything the model service computes from the design lattice
+at startup: the lattice cache behind the TWISS and RMAT tables, and the results
+of read-only Tao commands run before the first change to the model (the
+discovery queries other services make when they start up).
+
+The cache is keyed on a fingerprint of the Tao init file and every lattice file
+it references, so editing any of them invalidates it.
+"""
+import os
+import re
+import hashlib
+import pickle
+import logging
+import tempfile
+
+L = logging.getLogger(__name__)
+
+#Bump this when the format of the cached data changes.
+STARTUP_CACHE_VERSION = 1
+#Quoted paths (tao.init: design_lattice(1)%file = "...") and Bmad 'call, file = ...' statements.
+FILE_REF_RE = re.compile(r"""["']([^"'\n]+)["']|file\s*=\s*([^\s,"'!]+)""", re.IGNORECASE)
+
+def cache_dir():
+    return os.environ.get('SIMULACRUM_CACHE_DIR', os.path.join(os.path.expanduser("~"), ".cache", "simulacrum"))
+
+def cache_path(name):
+    return os.path.join(cache_dir(), "{}_startup.pickle".format(name.lower()))
+
+def lattice_fingerprint(init_file):
+    """
+    Hashes init_file, and every file it references, recursively.
+    References that don't point at an existing file are ignored.
+    """
+    h = hashlib.sha256()
+    h.update(str(STARTUP_CACHE_VERSION).encode())
+    h.update(os.environ.get('TAO_LIB', '').encode())
+    seen = set()
+    pending = [os.path.realpath(init_file)]
+    while pending:
+        path = pending.pop()
+        if path in seen:
+            continue
+        seen.add(path)
+        with open(path, 'rb') as f:
+            contents = f.read()
+        h.update(path.encode())
+        h.update(contents)
+        for quoted, called in FILE_REF_RE.findall(contents.decode('utf-8', errors='ignore')):
+            ref = os.path.expandvars(quoted or called)
+            ref = os.path.realpath(os.path.join(os.path.dirname(path), ref))
+            if os.path.isfile(ref):
+                pending.append(ref)
+    return h.hexdigest()
+
+def load(name, fingerprint):
+    """
+    Returns the cached data for the model called name, or None if there isn't
+    any, or if it was made from a different lattice.  A cache that can't be
+    read is deleted, so the next save replaces it.
+    """
+    path = cache_path(name)
+    try:
+        with open(path, 'rb') as f:
+            cached = pickle.load(f)
+        if cached.get('fingerprint') != fingerprint:
+            return None
+    except FileNotFoundError:
+        return None
+    except Exception:
+        L.warning("Discarding unreadable startup cache %s.", path, exc_info=True)
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        return None
+    return cached
+
+def save(name, fingerprint, lattice_cache, command_results):
+    """
+    Writes the cache for the model called name.  The file is written to a
+    temporary file and renamed, so a reader never sees a partial cache.
+    """
+    os.makedirs(cache_dir(), exist_ok=True)
+    data = {'fingerprint': fingerprint, 'lattice_cache': lattice_cache, 'command_results': command_results}
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir(), suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path(name))
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
@@ -0,0 +1,59 @@
+import fnmatch
+import unittest
+from command_log import CommandLog
+
+ELEMENTS = {"Q1": "Quadrupole", "Q2": "Quadrupole", "B1": "Sbend"}
+
+def replay(cmds):
+    """
+    A toy lattice, where a gradient set while field_master is off is a
+    normalized strength, and means something else than one set while it is on.
+    """
+    lattice = {name: {'field_master': 'F'} for name in ELEMENTS}
+    for cmd in cmds:
+        _, _, targets, attr, _, value = cmd.split()
+        for target in targets.split(","):
+            ele_class, _, pattern = target.rpartition("::")
+            for name in ELEMENTS:
+                if fnmatch.fnmatch(name, pattern) and ele_class in ("", ELEMENTS[name]):
+                    if attr == 'field_master':
+                        lattice[name][attr] = value
+                    else:
+                        lattice[name][attr] = (value, lattice[name]['field_master'])
+    return lattice
+
+class CommandLogTest(unittest.TestCase):
+    def check(self, cmds):
+        log = CommandLog()
+        for cmd in cmds:
+            log.append(1, cmd)
+        compacted = log.commands()[1]
+        self.assertEqual(replay(compacted), replay(cmds))
+        return compacted
+
+    def test_field_master_resent_after_gradients(self):
+        #The magnet service sets field_master on every start.
+        fm = "set ele Quadrupole::*,Sbend::* field_master = T"
+        compacted = self.check([fm, "set ele Q1 b1_gradient = 1", "set ele B1 b_field = 2", fm, "set ele Q1 b1_gradient = 3"])
+        self.assertEqual(compacted.index(fm), 0)
+
+    def test_field_master_on_one_element(self):
+        self.check(["set ele Q1 b1_gradient = 1", "set ele Q1 field_master = T", "set ele Q1 b1_gradient = 2",
+                    "set ele Q1 field_master = F", "set ele Q1 field_master = T"])
+
+    def test_repeated_settings_are_compacted(self):
+        compacted = self.check(["set ele Q1 b1_gradient = {}".format(i) for i in range(100)] + ["set ele Q2 b1_gradient = 1", "set ele Q1 b1_gradient = 5"])
+        self.assertEqual(compacted, ["set ele Q2 b1_gradient = 1", "set ele Q1 b1_gradient = 5"])
+
+    def test_wildcard_overlap(self):
+        self.check(["set ele Q1 b1_gradient = 1", "set ele Q* b1_gradient = 2", "set ele Q1 b1_gradient = 3", "set ele Q* b1_gradient = 4"])
+
+    def test_durable_only_leaves_out_jitter(self):
+        log = CommandLog()
+        log.append(1, "set ele Q1 b1_gradient = 1")
+        log.append(2, "set ele Q1 b1_gradient_err = 0.1", durable=False)
+        self.assertEqual(log.commands(durable_only=True), (2, ["set ele Q1 b1_gradient = 1"]))
+        self.assertEqual(log.commands()[1], ["set ele Q1 b1_gradient = 1", "set ele Q1 b1_gradient_err = 0.1"])
+
+if __name__ == '__main__':
+    unittest.main()
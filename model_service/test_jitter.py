@@ -0,0 +1,19 @@
+import unittest
+import numpy as np
+import jitter
+
+class JitterEngineTest(unittest.TestCase):
+    def test_masked_group_reads_only_jittered_elements(self):
+        #The middle element is designed with a zero value, so it isn't jittered,
+        #but the current values still come back for every matching element.
+        source = {'name': 'amplitude', 'elements': 'Lcavity::*', 'attribute': 'gradient_err', 'relative_to': 'gradient', 'white': 1e-3}
+        engine = jitter.JitterEngine(1.0, seed=0)
+        engine.add_source(source, ["A", "C"], [10.0, 30.0], mask=np.array([0, 2]))
+        cmds = engine.commands(0.0, [np.array([1.0, 2.0, 3.0])])
+        self.assertEqual([cmd.split()[2] for cmd in cmds], ["A", "C"])
+        np.testing.assert_allclose(engine.base, [1.0, 3.0])
+        cmds = engine.commands(1.0, [np.array([5.0, 2.0, engine.applied[1]])])
+        np.testing.assert_allclose(engine.base, [5.0, 3.0])
+
+if __name__ == '__main__':
+    unittest.main()
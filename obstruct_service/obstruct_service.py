@@ -8,7 +8,6 @@ from collections import OrderedDict
 from caproto.server import ioc_arg_parser, run, pvproperty, PVGroup
 from caproto import ChannelType
 import simulacrum
-import zmq
 from zmq.asyncio import Context
 
 #set up python logger
@@ -39,10 +38,10 @@ class StopperPV(PVGroup):
         ioc = instance.group
         if value == "IN":
             await ioc.sts.write(2)
-            self.change_callback(self, 2)
+            await self.change_callback(self, 2)
         elif value == "OUT":
             await ioc.sts.write(1)
-            self.change_callback(self, 1)
+            await self.change_callback(self, 1)
         else:
             L.warning("Warning, using a non-implemented stopper control function.")
         return self.ctrl_strings.index(value)
@@ -115,7 +114,7 @@ class CollimatorPV(PVGroup):
         self.getcenter._data['value'] = center
 
         #callback to update bmad
-        self.change_callback(self, val)
+        await self.change_callback(self, val)
         return value 
     
     @setright.putter
@@ -128,7 +127,7 @@ class CollimatorPV(PVGroup):
         self.getgap._data['value'] = gap
         self.setcenter._data['value'] = center
         self.getcenter._data['value'] = center
-        self.change_callback(self, val)
+        await self.change_callback(self, val)
         return value 
 
 
@@ -149,7 +148,7 @@ class CollimatorPV(PVGroup):
         
         #update model
         val = [ioc.getleft.value, ioc.getright.value]
-        self.change_callback(self, val)
+        await self.change_callback(self, val)
         return value
 
 
@@ -164,7 +163,7 @@ class CollimatorPV(PVGroup):
         self.getright._data['value'] = self.setright._data['value']
         await asyncio.gather(self.getleft.publish(0), self.getright.publish(0))
         val = [ioc.getleft.value, ioc.getright.value]
-        self.change_callback(self, val)
+        await self.change_callback(self, val)
         return value
 
 
@@ -173,10 +172,9 @@ class CollimatorPV(PVGroup):
 
 
 
-#parse the bmad 'show lat' return 
+#parse the lat_query table of limits
 def parse_limits(table):
-    limits = [row.split() for row in table]
-    return {ele: ( float(x1), float(x2), float(y1), float(y2) ) for (_, ele, _, _, _, x1, x2, y1, y2) in limits} 
+    return {ele: ( float(x1), float(x2), float(y1), float(y2) ) for (ele, x1, x2, y1, y2) in table.tolist()} 
 
 
 class ObstructorService(simulacrum.Service):
@@ -187,9 +185,6 @@ class ObstructorService(simulacrum.Service):
         {v:k for k, v in d}
         return d 
 
-    def recv_pytao():
-        for line in self.cmd_socket.recv_pyobj()['result']:
-            L.info(line)
     #initialize service
     def __init__(self):
         super().__init__()
@@ -203,9 +198,7 @@ class ObstructorService(simulacrum.Service):
 
         #network stuff <consult M. Gibbs> 
         self.ctx = Context.instance()
-        #cmd socket is a synchronous socket, we don't want the asyncio context.
-        self.cmd_socket = zmq.Context().socket(zmq.REQ)
-        self.cmd_socket.connect("tcp://127.0.0.1:{}".format(os.environ.get('MODEL_PORT', 12312)))
+        self.model_client = simulacrum.ModelClient()
         #build dictionary of start values
         self.init_sts = self.get_obstruct_statuses_from_model()
         pvs={}
@@ -238,15 +231,9 @@ class ObstructorService(simulacrum.Service):
     def get_obstruct_statuses_from_model(self):
 
         self.init_sts={}
-        #build and send tao command
-        command = 'show lat -no_label_lines'
-        for x in self.limit_names:
-            command+=(' -attrib {att}'.format(att=x))
-        for dev in list(self.stopper_names)+list(self.x_collimator_names):
-            command+= (' ' + dev)
-        self.cmd_socket.send_pyobj({"cmd": "tao", "val": command})
-        #collect and parse result into dictionary 
-        table = self.cmd_socket.recv_pyobj()['result']
+        #query the limits of every obstructor
+        elements = ','.join(list(self.stopper_names)+list(self.x_collimator_names))
+        table = self.model_client.lat_query_sync(elements, self.limit_names, track_only=False)
         #dictionary of {ele_name:[x1_limit, x2_limit, y1_limit, y2_limit]}
         init_vals = parse_limits(table)
        
@@ -303,11 +290,8 @@ class ObstructorService(simulacrum.Service):
     
     #def on_profmon_change(self):
     
-    def on_obstructor_change(self, pv, value):
+    async def on_obstructor_change(self, pv, value):
         #define obstructor object type
-        self.cmd_socket.send_pyobj({"cmd": "tao", "val": "set global lattice_calc_on=F"})
-        msg = self.cmd_socket.recv_pyobj()['result']
-        L.info(msg)
         L.info('Obstructor changing...')
         msg = 'PV: {}'.format(pv)
         L.info(msg)
@@ -324,15 +308,11 @@ class ObstructorService(simulacrum.Service):
         else:
             L.warning('Warning, using a non-implemented control function....')
 
-    #build and send tao command
+    #build tao commands, and send them as one transaction so the model only recalculates once
+        commands = []
         for i in range(len(self.limit_names)):
-            command = 'set ele {element} {attr}={val}'.format(element=pv.element_name, attr=self.limit_names[i], val=self.lim[i])
-            self.cmd_socket.send_pyobj({"cmd": "tao", "val": command})
-            msg=self.cmd_socket.recv_pyobj()['result']
-            L.info(msg)
-        #restart global computation
-        self.cmd_socket.send_pyobj({"cmd": "tao", "val": "set global lattice_calc_on=T"})
-        msg = self.cmd_socket.recv_pyobj()['result']
+            commands.append('set ele {element} {attr}={val}'.format(element=pv.element_name, attr=self.limit_names[i], val=self.lim[i]))
+        msg = await self.model_client.request({"cmd": "transaction", "val": commands})
         L.info(msg)
     
 
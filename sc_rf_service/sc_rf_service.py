@@ -6,7 +6,6 @@ from collections import OrderedDict
 from caproto.server import ioc_arg_parser, run, pvproperty, PVGroup
 from caproto import ChannelType
 import simulacrum
-import zmq
 from zmq.asyncio import Context
 
 #set up python logger
@@ -35,24 +34,23 @@ class CavityPV(PVGroup):
 
     @pdes.putter
     async def pdes(self, instance, value):
-        self.change_callback(self, value, "PDES")
+        await self.change_callback(self, value, "PDES")
         return;
     @gdes.putter
     async def gdes(self, instance, value):
-        self.change_callback(self,value, "GDES")
+        await self.change_callback(self,value, "GDES")
         return
     @pref.putter
     async def pref(self, instance, value):
-        self.change_callback(self, value, "PREF")
+        await self.change_callback(self, value, "PREF")
         return
     @ssa_ctrl.putter
     async def ssa_ctrl(self, instance, value):
-        self.change_callback(self, value, "SSA_ON");
+        await self.change_callback(self, value, "SSA_ON");
         return
 
 def _parse_cav_table(table):
-    splits = [row.split() for row in table]
-    return { simulacrum.util.convert_element_to_device(elemName): (float(bmadGrad), float(bmadPhas), float(Z), elemName) for (_, elemName, _, Z, _, bmadGrad, bmadPhas) in splits }
+    return { simulacrum.util.convert_element_to_device(elemName): (float(bmadGrad), float(bmadPhas), float(Z), elemName) for (elemName, Z, bmadGrad, bmadPhas) in table[["name", "s", "gradient", "phi0"]].tolist() }
 
 def _make_linac_table(init_vals):
     L2list = ''.join([f"CAVL{number:02d}*," for number in range(4,16)])
@@ -71,9 +69,7 @@ class CavityService(simulacrum.Service):
     def __init__(self):
         super().__init__()
         self.ctx = Context.instance()
-        #cmd socket is a synchronous socket, we don't want the asyncio context.
-        self.cmd_socket = zmq.Context().socket(zmq.REQ)
-        self.cmd_socket.connect("tcp://127.0.0.1:{}".format(os.environ.get('MODEL_PORT', 12312)))
+        self.model_client = simulacrum.ModelClient()
         init_vals = self.get_cavity_ACTs_from_model()
         cav_pvs = {device_name: CavityPV(device_name, self.on_cavity_change, initial_values=init_vals[device_name], prefix=device_name) for device_name in init_vals.keys()}
         #setting up convenient linac section PVs for changing all of the L1B/L2B/L3B cavities simultaneously. 
@@ -85,12 +81,11 @@ class CavityService(simulacrum.Service):
 
     def get_cavity_ACTs_from_model(self):
         init_vals = {}
-        self.cmd_socket.send_pyobj({"cmd": "tao", "val": "show lat -no_label_lines -attribute gradient -attribute phi0 lcavity::* -no_slaves"})
-        table = self.cmd_socket.recv_pyobj()['result']
+        table = self.model_client.lat_query_sync("lcavity::*", ["s", "gradient", "phi0"], track_only=False, no_slaves=True)
         init_vals = _parse_cav_table(table)
         return init_vals
     
-    def on_cavity_change(self, cavity_pv, value, parameter):
+    async def on_cavity_change(self, cavity_pv, value, parameter):
         element = cavity_pv.element_name
         if parameter == "PREF":
             return
@@ -106,8 +101,7 @@ class CavityService(simulacrum.Service):
             value = 'T' if value is 'ON' else 'F' 
         cmd = f'set ele {element} {cav_attr} = {value}'
         L.debug(cmd)
-        self.cmd_socket.send_pyobj({"cmd": "tao", "val": cmd})         
-        self.cmd_socket.recv_pyobj()   
+        await self.model_client.request({"cmd": "tao", "val": cmd})
 
 def main():
     service = CavityService()
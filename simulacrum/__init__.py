@@ -1,5 +1,9 @@
 from .service import Service
 from ._version import get_versions
 from . import util
+from . import broadcast
+from . import model_client
+from .model_client import ModelClient
+from .subscriber import Subscriber
 __version__ = get_versions()['version']
 del get_versions
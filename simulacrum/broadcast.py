@@ -0,0 +1,100 @@
+"""
+The model service broadcasts data as multipart ZMQ messages:
+
+    [topic, header, payload, *extra_frames]
+
+topic is one of the topic names below.  Subscribers pass it to zmq.SUBSCRIBE,
+so they never receive messages for other topics.  header is a fixed-size
+binary struct (see HEADER).  payload holds the raw bytes of a numpy array, or
+a pickled python object if the header's dtype is PICKLE_DTYPE.  Some topics
+add extra frames after the payload.
+"""
+import time
+import pickle
+import struct
+from collections import namedtuple, defaultdict
+import numpy as np
+import zmq
+
+ORBIT = b"orbit"
+PROF_DATA = b"prof_data"
+UND_TWISS = b"und_twiss"
+PART_POSITIONS = b"part_positions"
+#Topics of client-registered streams start with this, followed by a fixed-length
+#hash of the stream's query.  See simulacrum.model_client.register_stream.
+STREAM_PREFIX = b"stream:"
+
+MAX_DIMS = 4
+#generation, sequence, timestamp, dtype string, flags, ndim, shape (padded to MAX_DIMS)
+HEADER = struct.Struct("<QQd16sBB{}Q".format(MAX_DIMS))
+PICKLE_DTYPE = "pickle"
+
+#Header flags.  PREDICTED marks data that was extrapolated from the last
+#broadcast, not read from the lattice, like the orbits sent with --fast-orbit.
+#It has the same generation as the real data that will replace it.
+PREDICTED = 0x1
+
+Header = namedtuple("Header", ["generation", "sequence", "timestamp", "dtype", "shape", "flags"])
+
+def pack_header(generation, sequence, dtype, shape, timestamp=None, flags=0):
+    if len(shape) > MAX_DIMS:
+        raise ValueError("Broadcast arrays can have at most {} dimensions.".format(MAX_DIMS))
+    if timestamp is None:
+        timestamp = time.time()
+    padded_shape = tuple(shape) + (0,)*(MAX_DIMS - len(shape))
+    return HEADER.pack(generation, sequence, timestamp, dtype.encode('ascii'), flags, len(shape), *padded_shape)
+
+def unpack_header(buf):
+    generation, sequence, timestamp, dtype, flags, ndim, *shape = HEADER.unpack(buf)
+    return Header(generation, sequence, timestamp, dtype.rstrip(b'\0').decode('ascii'), tuple(shape[:ndim]), flags)
+
+def decode(frames):
+    """
+    Decodes a received broadcast.  frames is the list from recv_multipart,
+    with either bytes or zmq.Frame items.
+    Returns: a (topic, header, payload, extra_frames) tuple.  Array payloads
+    are read-only numpy views on the received frame, not copies.
+    """
+    topic = _bytes(frames[0])
+    header = unpack_header(_buffer(frames[1]))
+    if header.dtype == PICKLE_DTYPE:
+        payload = pickle.loads(_buffer(frames[2]))
+    else:
+        payload = np.frombuffer(_buffer(frames[2]), dtype=header.dtype).reshape(header.shape)
+    return topic, header, payload, frames[3:]
+
+def _buffer(frame):
+    return frame.buffer if isinstance(frame, zmq.Frame) else frame
+
+def _bytes(frame):
+    return frame.bytes if isinstance(frame, zmq.Frame) else frame
+
+class Publisher:
+    """
+    Wraps a PUB socket, and numbers every message on a topic with a sequence
+    number that increases by one each time, so subscribers can spot drops.
+    """
+    def __init__(self, socket):
+        self.socket = socket
+        self.sequence = defaultdict(int)
+
+    def next_header(self, topic, generation, dtype, shape, flags=0):
+        self.sequence[topic] += 1
+        return pack_header(generation, self.sequence[topic], dtype, shape, flags=flags)
+
+    def send_array(self, topic, array, generation, extra_frames=(), flags=0):
+        """
+        Sends a numpy array without copying it into a python bytes object.
+        Note that pyzmq still copies frames smaller than zmq.COPY_THRESHOLD.
+        Bigger arrays are sent from the buffer itself, so they must not be
+        modified after they are sent.
+        """
+        array = np.ascontiguousarray(array)
+        if array.dtype.fields is not None:
+            raise ValueError("Structured arrays can't be broadcast, send one array per field instead.")
+        header = self.next_header(topic, generation, array.dtype.str, array.shape, flags)
+        self.socket.send_multipart([topic, header, array] + list(extra_frames), copy=False)
+
+    def send_pyobj(self, topic, obj, generation):
+        header = self.next_header(topic, generation, PICKLE_DTYPE, ())
+        self.socket.send_multipart([topic, header, pickle.dumps(obj)])
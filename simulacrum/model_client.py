@@ -0,0 +1,173 @@
+"""
+Helpers for services that talk to the model service's command socket.
+"""
+import os
+import pickle
+import asyncio
+import itertools
+import numpy as np
+import zmq
+from zmq.asyncio import Context
+
+#Commands that are sent in one 'batch' request when several are issued in the
+#same event loop iteration.  Commands with binary or streamed replies, and
+#long-running ones, are always sent on their own.
+BATCH_CMDS = frozenset(("tao", "transaction", "echo", "send_orbit", "send_profiles_twiss", "send_und_twiss", "begin", "commit", "abort"))
+
+class ModelClient:
+    """
+    An asyncio client for the model service's command socket.  It uses a
+    DEALER socket, so any number of requests can be in flight at once, and
+    each one waits for its own reply without blocking the event loop.
+    Requests issued in the same event loop iteration are sent together, in
+    order, and each run of consecutive ones in BATCH_CMDS goes in a single
+    'batch' request.
+    Every request has a timeout (timeout=None waits forever).  When the model
+    service restarts, ZMQ reconnects the socket by itself, and requests that
+    were lost with the old model service time out, instead of wedging the
+    socket like they would with a REQ socket.
+    The methods ending in _sync are for use before the event loop is running,
+    like in a service's __init__.  By default they wait for the model service
+    to come up, however long that takes.
+    """
+    def __init__(self, address=None, timeout=30.0):
+        self.address = address or "tcp://127.0.0.1:{}".format(os.environ.get('MODEL_PORT', 12312))
+        self.timeout = timeout
+        self.socket = Context.instance().socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        if hasattr(zmq, 'HEARTBEAT_IVL'):
+            #Notice a dead model service quickly, even if its host vanished without closing the connection.
+            self.socket.setsockopt(zmq.HEARTBEAT_IVL, 1000)
+            self.socket.setsockopt(zmq.HEARTBEAT_TIMEOUT, 5000)
+        self.socket.connect(self.address)
+        self.ids = itertools.count(1)
+        #Request id -> future for the reply.
+        self.pending = {}
+        #Requests issued in this event loop iteration, waiting to be sent.
+        self.outbox = []
+        self.receiver = None
+
+    async def request(self, p, timeout=-1):
+        """
+        Sends a request dict, like {"cmd": "tao", "val": "show ele Q1"}, and
+        waits for the reply dict.  Binary frames that come with a reply (see
+        lat_query) are in its 'frames' key.  timeout defaults to the client's.
+        Raises asyncio.TimeoutError if no reply arrives in time.
+        """
+        loop = asyncio.get_event_loop()
+        if self.receiver is None or self.receiver.done():
+            self.receiver = loop.create_task(self.receive())
+        request_id = next(self.ids)
+        future = loop.create_future()
+        self.pending[request_id] = future
+        if not self.outbox:
+            loop.call_soon(self.flush)
+        self.outbox.append(dict(p, id=request_id))
+        try:
+            return await asyncio.wait_for(future, self.timeout if timeout == -1 else timeout)
+        finally:
+            self.pending.pop(request_id, None)
+
+    async def tao(self, cmd, timeout=-1):
+        """
+        Runs a Tao command.
+        Returns: the list of output lines.
+        """
+        reply = await self.request({"cmd": "tao", "val": cmd}, timeout)
+        if reply['status'] != 'ok':
+            raise reply['err']
+        return reply['result']
+
+    async def lat_query(self, elements, attributes, track_only=True, no_slaves=False, timeout=-1):
+        """
+        The asyncio version of lat_query, below.
+        """
+        reply = await self.request({"cmd": "lat_query", "val": {"elements": elements, "attributes": list(attributes), "track_only": track_only, "no_slaves": no_slaves}}, timeout)
+        return _decode_table(reply, reply['frames'])
+
+    async def register_stream(self, elements, attributes, track_only=True, no_slaves=False, timeout=-1):
+        """
+        The asyncio version of register_stream, below.
+        """
+        reply = await self.request({"cmd": "register_stream", "val": {"elements": elements, "attributes": list(attributes), "track_only": track_only, "no_slaves": no_slaves}}, timeout)
+        if reply['status'] != 'ok':
+            raise reply['err']
+        return reply['result']['topic'], reply['result']['names']
+
+    def request_sync(self, p, timeout=None):
+        return asyncio.get_event_loop().run_until_complete(self.request(p, timeout))
+
+    def tao_sync(self, cmd, timeout=None):
+        return asyncio.get_event_loop().run_until_complete(self.tao(cmd, timeout))
+
+    def lat_query_sync(self, elements, attributes, track_only=True, no_slaves=False, timeout=None):
+        return asyncio.get_event_loop().run_until_complete(self.lat_query(elements, attributes, track_only, no_slaves, timeout))
+
+    def flush(self):
+        requests, self.outbox = self.outbox, []
+        #Runs of consecutive batchable requests go as one batch, and everything
+        #is sent in the order it was issued.
+        for batchable, run in itertools.groupby(requests, key=lambda p: p['cmd'] in BATCH_CMDS):
+            run = list(run)
+            if batchable and len(run) > 1:
+                run = [{"cmd": "batch", "val": run, "id": next(self.ids)}]
+            for p in run:
+                self.socket.send_multipart([pickle.dumps(p)])
+
+    async def receive(self):
+        while True:
+            frames = await self.socket.recv_multipart()
+            reply = pickle.loads(frames[0])
+            reply['frames'] = frames[1:]
+            replies = reply['result'] if reply.get('batch') else [reply]
+            for reply in replies:
+                future = self.pending.get(reply.get('id'))
+                #Replies to requests that timed out are dropped.
+                if future is not None and not future.done():
+                    future.set_result(reply)
+
+def lat_query(socket, elements, attributes, track_only=True, no_slaves=False):
+    """
+    Fetches attributes of a group of elements from the model service in one
+    request, as a structured numpy array with a 'name' field and a float
+    field for each attribute.  socket is a synchronous REQ (or DEALER) socket
+    connected to the model service.  Raises the model service's error if the
+    query fails.
+    Example: lat_query(socket, "Quadrupole::*", ["l", "b1_gradient"])
+    """
+    socket.send_pyobj({"cmd": "lat_query", "val": {"elements": elements, "attributes": list(attributes), "track_only": track_only, "no_slaves": no_slaves}})
+    return decode_lat_query(socket.recv_multipart())
+
+def decode_lat_query(frames):
+    """
+    Decodes the frames of a lat_query reply.  The array is a read-only view
+    on the received frame, not a copy.
+    """
+    return _decode_table(pickle.loads(frames[0]), frames[1:])
+
+def _decode_table(reply, frames):
+    if reply['status'] != 'ok':
+        raise reply['err']
+    return np.frombuffer(frames[0], dtype=np.dtype(reply['result']['dtype'])).reshape(reply['result']['shape'])
+
+def register_stream(socket, elements, attributes, track_only=True, no_slaves=False):
+    """
+    Registers a lattice query with the model service, which then broadcasts
+    its values on every model change, as an (n_attributes, n_elements)
+    array.  Identical queries from different services share one stream.
+    Subscribe to the returned topic on the broadcast socket, and decode the
+    messages with simulacrum.broadcast.decode.
+    Returns: a (topic, element names) tuple.
+    Example: register_stream(socket, "Instrument::*", ["ele.a.beta", "ele.x.eta"])
+    """
+    socket.send_pyobj({"cmd": "register_stream", "val": {"elements": elements, "attributes": list(attributes), "track_only": track_only, "no_slaves": no_slaves}})
+    reply = socket.recv_pyobj()
+    if reply['status'] != 'ok':
+        raise reply['err']
+    return reply['result']['topic'], reply['result']['names']
+
+def unregister_stream(socket, topic):
+    socket.send_pyobj({"cmd": "unregister_stream", "val": topic})
+    reply = socket.recv_pyobj()
+    if reply['status'] != 'ok':
+        raise reply['err']
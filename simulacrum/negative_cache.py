@@ -0,0 +1,45 @@
+import time
+from collections import OrderedDict
+
+class NegativeCache:
+    """
+    Remembers PV names that recently failed to match any PV or route, so
+    repeated searches for names we don't serve cost one dict lookup.
+    Entries expire after ttl seconds, and past max_entries the names that
+    were missed longest ago are dropped first.  Whoever adds PVs or routes
+    must call clear (or discard, for a single name), since a name that
+    missed before might not miss anymore.
+    hits counts lookups answered from the cache, misses counts the rest.
+    """
+    def __init__(self, max_entries=100000, ttl=60.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        #name -> expiry time, oldest first.
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, name):
+        expiry = self.entries.get(name)
+        if expiry is not None:
+            if expiry > time.monotonic():
+                self.hits += 1
+                return True
+            del self.entries[name]
+        self.misses += 1
+        return False
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, name):
+        self.entries.pop(name, None)
+        self.entries[name] = time.monotonic() + self.ttl
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def discard(self, name):
+        self.entries.pop(name, None)
+
+    def clear(self):
+        self.entries.clear()
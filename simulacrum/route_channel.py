@@ -2,7 +2,22 @@ from caproto import (ChannelString, ChannelEnum, ChannelDouble,
                      ChannelChar, ChannelData, ChannelInteger,
                      ChannelByte, ChannelShort, AccessRights)
 
-class RouteChannel:
+class SubscriberCount:
+    """
+    Counts a channel's subscriptions, so channels that are created on demand
+    can be dropped when nobody is watching them.  See Service.evict_idle_channels.
+    """
+    subscriber_count = 0
+
+    async def subscribe(self, queue, sub_spec, sub):
+        self.subscriber_count += 1
+        return await super().subscribe(queue, sub_spec, sub)
+
+    async def unsubscribe(self, queue, sub_spec):
+        self.subscriber_count = max(self.subscriber_count - 1, 0)
+        return await super().unsubscribe(queue, sub_spec)
+
+class RouteChannel(SubscriberCount):
     def __init__(self, pvname, getter, setter=None, new_subscription=None, remove_subscription=None, **kwargs):
         self.pvname = pvname
         self.getter = getter
@@ -42,6 +57,17 @@ class RouteChannel:
             await self.remove_subscription(self.pvname, self)
         return await super().unsubscribe(queue, sub_spec)
     
+class StaticDouble(SubscriberCount, ChannelDouble):
+    """
+    A channel that only holds whatever was last written to it.  Once
+    written, it can't be rebuilt, so written is set and it isn't evicted.
+    """
+    written = False
+
+    async def write(self, value, **kwargs):
+        self.written = True
+        return await super().write(value, **kwargs)
+
 class StringRoute(RouteChannel, ChannelString):
     pass
 
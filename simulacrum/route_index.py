@@ -0,0 +1,102 @@
+import re
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+#Patterns with backreferences can't be combined into one regex, since their
+#group numbers change.
+BACKREFERENCE_RE = re.compile(r"\\[1-9]|\(\?P=")
+
+class RouteIndex:
+    """
+    Finds the route whose pattern matches a PV name, without trying every
+    route's pattern.  Routes are filed in a trie under the literal prefix of
+    their pattern: everything before the first regex operator.  A lookup walks
+    the trie along the name, so only routes whose literal prefix is a prefix
+    of the name are tried, and the routes filed under the same prefix are
+    tried together, with one combined regex.  A name that doesn't start like
+    any route costs a few dict lookups, and no regex work at all.
+    Like a linear scan of the routes, the last matching route added wins.
+    """
+    def __init__(self):
+        self.root = _Node()
+        self.n_routes = 0
+
+    def add(self, pattern):
+        """
+        Adds a compiled pattern.
+        Returns: the index of the route, counting from 0 in the order routes are added.
+        """
+        index = self.n_routes
+        self.n_routes += 1
+        node = self.root
+        for char in literal_prefix(pattern):
+            node = node.children.setdefault(char, _Node())
+        node.add(index, pattern)
+        return index
+
+    def match(self, name):
+        """
+        Returns: the index of the last added route matching name, or None.
+        """
+        best = None
+        node = self.root
+        for char in name:
+            if node.routes:
+                index = node.match(name)
+                if index is not None and (best is None or index > best):
+                    best = index
+            node = node.children.get(char)
+            if node is None:
+                return best
+        if node.routes:
+            index = node.match(name)
+            if index is not None and (best is None or index > best):
+                best = index
+        return best
+
+class _Node:
+    def __init__(self):
+        self.children = {}
+        #(index, pattern) for each route filed here, newest first.
+        self.routes = []
+        self.combined = None
+
+    def add(self, index, pattern):
+        self.routes.insert(0, (index, pattern))
+        self.combined = None
+        if any(not _combinable(p) for _, p in self.routes):
+            return
+        #Alternatives are tried in order, so the newest route comes first.
+        try:
+            self.combined = re.compile("|".join("(?P<_route{}>{})".format(i, p.pattern) for i, p in self.routes))
+        except re.error:
+            self.combined = None
+
+    def match(self, name):
+        if self.combined is not None:
+            m = self.combined.match(name)
+            #The route's own group closes after any groups inside its pattern.
+            return None if m is None else int(m.lastgroup[len("_route"):])
+        for index, pattern in self.routes:
+            if pattern.match(name) is not None:
+                return index
+        return None
+
+def _combinable(pattern):
+    default_flags = re.compile("").flags
+    return pattern.flags == default_flags and isinstance(pattern.pattern, str) and BACKREFERENCE_RE.search(pattern.pattern) is None
+
+def literal_prefix(pattern):
+    """
+    Returns: the literal characters every match of pattern starts with.
+    """
+    if pattern.flags & re.IGNORECASE:
+        return ""
+    prefix = []
+    for op, arg in sre_parse.parse(pattern.pattern, pattern.flags):
+        if op != sre_parse.LITERAL:
+            break
+        prefix.append(chr(arg))
+    return "".join(prefix)
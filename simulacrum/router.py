@@ -2,13 +2,15 @@
 import asyncio
 from caproto.server import ioc_arg_parser, run
 
-from collections import defaultdict
-from caproto import (ChannelString, ChannelEnum, ChannelDouble,
+from collections import defaultdict, OrderedDict
+from caproto import (ChannelString, ChannelEnum,
                      ChannelChar, ChannelData, ChannelInteger,
                      ChannelType)
 from route_channel import (StringRoute, EnumRoute, DoubleRoute,
                            CharRoute, IntegerRoute, BoolRoute,
-                           ByteRoute, ShortRoute, BoolRoute)
+                           ByteRoute, ShortRoute, BoolRoute, StaticDouble)
+from route_index import RouteIndex
+from negative_cache import NegativeCache
 import re
 from arch import get_mean_and_std
 import bpm_sim.bpm as bpm
@@ -43,27 +45,70 @@ default_values = {
 }
 
 class Router(defaultdict):
-    def __init__(self, factory=None):
+    def __init__(self, factory=None, negative_cache_size=100000, negative_cache_ttl=60.0, max_channels=10000):
         super().__init__(factory)
         self.routes = []
+        self.route_index = RouteIndex()
+        #Names that recently matched no route, so they go straight to the default factory.
+        self.negative_cache = NegativeCache(negative_cache_size, negative_cache_ttl)
+        #Every channel made by __missing__, least recently used first.  Past
+        #max_channels, the ones without subscribers are dropped.
+        self.dynamic_channels = OrderedDict()
+        self.max_channels = max_channels
         
     def add_route(self, pattern, data_type, get, put=None, new_subscription=None, remove_subscription=None):
         self.routes.append((re.compile(pattern), data_type, get, put, new_subscription, remove_subscription))
+        self.route_index.add(self.routes[-1][0])
+        self.negative_cache.clear()
     
     def __contains__(self, key):
         return True
 
+    def __getitem__(self, pvname):
+        chan = super().__getitem__(pvname)
+        if pvname in self.dynamic_channels:
+            self.dynamic_channels.move_to_end(pvname)
+        return chan
+
     def __missing__(self, pvname):
+        if pvname in self.negative_cache:
+            #A name that missed recently, and whose static channel was evicted
+            #as idle.  Hand out a fresh one without storing it, so repeated
+            #searches don't push other channels out.
+            return self.default_factory(pvname)
         chan = None
-        for (pattern, data_type, get_route, put_route, new_subscription_route, remove_subscription_route) in self.routes:
-            print("Testing {} against {}".format(pvname, pattern.pattern))
-            if pattern.match(pvname) != None:
-                chan = self.make_route_channel(pvname, data_type, get_route, put_route, new_subscription_route, remove_subscription_route)
+        index = self.route_index.match(pvname)
+        if index is not None:
+            (pattern, data_type, get_route, put_route, new_subscription_route, remove_subscription_route) = self.routes[index]
+            chan = self.make_route_channel(pvname, data_type, get_route, put_route, new_subscription_route, remove_subscription_route)
         if chan is None:
             # No routes matched, so revert to making static data.
+            self.negative_cache.add(pvname)
             chan = self.default_factory(pvname)
         ret = self[pvname] = chan
+        self.evict_idle_channels(room=1)
+        self.dynamic_channels[pvname] = chan
         return ret
+
+    def evict_idle_channels(self, room=0):
+        """
+        Drops the least recently used channels that have no subscribers, until
+        there is room for room more within max_channels.  Channels that don't
+        count their subscribers are always considered idle.  Static channels
+        that have been written are kept, since their value can't be rebuilt.
+        """
+        excess = len(self.dynamic_channels) + room - self.max_channels
+        if excess <= 0:
+            return
+        idle = []
+        for pvname, chan in self.dynamic_channels.items():
+            if len(idle) == excess:
+                break
+            if getattr(chan, 'subscriber_count', 0) == 0 and not getattr(chan, 'written', False):
+                idle.append(pvname)
+        for pvname in idle:
+            del self.dynamic_channels[pvname]
+            self.pop(pvname, None)
     
     def make_route_channel(self, pvname, data_type, getter, setter=None, new_subscription=None, remove_subscription=None):
         if data_type in route_type_map:
@@ -75,7 +120,7 @@ class Router(defaultdict):
 
 def fabricate_channel(pvname):
     print("Making a static channel for key: {}".format(pvname))
-    return ChannelDouble(value=0)
+    return StaticDouble(value=0)
 
 def main():
     _, run_options = ioc_arg_parser(
@@ -8,6 +8,9 @@ from caproto.server import PVGroup
 from .route_channel import (StringRoute, EnumRoute, DoubleRoute,
                            CharRoute, IntegerRoute, BoolRoute,
                            ByteRoute, ShortRoute, BoolRoute)
+from .route_index import RouteIndex
+from .negative_cache import NegativeCache
+from collections import OrderedDict
 import re
 
 route_type_map = {
@@ -40,12 +43,23 @@ default_values = {
 }
 
 class Service(dict):
-    def __init__(self):
+    def __init__(self, negative_cache_size=100000, negative_cache_ttl=60.0, max_route_channels=10000):
         super().__init__()
         self.routes = []
+        #Finds the route for a PV name without trying every pattern, see RouteIndex.
+        self.route_index = RouteIndex()
+        #Names that recently matched no PV or route.  CA clients search for
+        #lots of PVs we don't serve, over and over.
+        self.negative_cache = NegativeCache(negative_cache_size, negative_cache_ttl)
+        #Channels created by routes, least recently used first.  Past
+        #max_route_channels, the ones without subscribers are dropped.
+        self.route_channels = OrderedDict()
+        self.max_route_channels = max_route_channels
         
     def add_route(self, pattern, data_type, get, put=None, new_subscription=None, remove_subscription=None):
         self.routes.append((re.compile(pattern), data_type, get, put, new_subscription, remove_subscription))
+        self.route_index.add(self.routes[-1][0])
+        self.negative_cache.clear()
     
     def add_pvs(self, pv_groups):
         if isinstance(pv_groups, PVGroup):
@@ -53,27 +67,63 @@ class Service(dict):
             pv_groups = {0: pv_groups}
         for prefix, group in pv_groups.items():
             self.update(**group.pvdb)
+        self.negative_cache.clear()
+
+    def __setitem__(self, pvname, chan):
+        super().__setitem__(pvname, chan)
+        self.negative_cache.discard(pvname)
     
+    def find_route(self, pvname):
+        """
+        Returns the last added route whose pattern matches pvname, or None.
+        """
+        if not isinstance(pvname, str) or pvname in self.negative_cache:
+            return None
+        index = self.route_index.match(pvname)
+        if index is None:
+            self.negative_cache.add(pvname)
+            return None
+        return self.routes[index]
+
     def __getitem__(self, pvname):
-        chan = None
-        try:
-            return super().__getitem__(pvname)
-        except KeyError:   
-            for (pattern, data_type, get_route, put_route, new_subscription_route, remove_subscription_route) in self.routes:
-                if pattern.match(pvname) != None:
-                    chan = self.make_route_channel(pvname, data_type, get_route, put_route, new_subscription_route, remove_subscription_route)
-            if chan is None:
-                raise KeyError
-            ret = self[pvname] = chan
-            return ret
+        #get instead of catching a KeyError, so a miss only raises the one KeyError callers expect.
+        chan = super().get(pvname)
+        if chan is not None:
+            if pvname in self.route_channels:
+                self.route_channels.move_to_end(pvname)
+            return chan
+        route = self.find_route(pvname)
+        if route is None:
+            raise KeyError(pvname)
+        (pattern, data_type, get_route, put_route, new_subscription_route, remove_subscription_route) = route
+        chan = self.make_route_channel(pvname, data_type, get_route, put_route, new_subscription_route, remove_subscription_route)
+        ret = self[pvname] = chan
+        self.evict_idle_channels(room=1)
+        self.route_channels[pvname] = chan
+        return ret
+
+    def evict_idle_channels(self, room=0):
+        """
+        Drops the least recently used route channels that have no subscribers,
+        until there is room for room more within max_route_channels.  A dropped
+        channel is simply made again by its route the next time its name is
+        looked up.
+        """
+        excess = len(self.route_channels) + room - self.max_route_channels
+        if excess <= 0:
+            return
+        idle = []
+        for pvname, chan in self.route_channels.items():
+            if len(idle) == excess:
+                break
+            if chan.subscriber_count == 0:
+                idle.append(pvname)
+        for pvname in idle:
+            del self.route_channels[pvname]
+            super().pop(pvname, None)
     
     def __contains__(self, key):
-        if super().__contains__(key):
-            return True
-        for (pattern, data_type, get_route, put_route, new_subscription_route, remove_subscription_route) in self.routes:
-            if pattern.match(pvname) != None:
-                return True
-        return False
+        return super().__contains__(key) or self.find_route(key) is not None
     
     def make_route_channel(self, pvname, data_type, getter, setter=None, new_subscription=None, remove_subscription=None):
         if data_type in route_type_map:
@@ -0,0 +1,89 @@
+import os
+import logging
+from collections import namedtuple, OrderedDict
+import zmq
+from zmq.asyncio import Context
+from . import broadcast
+
+L = logging.getLogger(__name__)
+
+Message = namedtuple("Message", ["topic", "header", "payload", "extra"])
+
+class Subscriber:
+    """
+    Receives the model service's broadcasts on one SUB socket, and passes
+    them to async handlers registered for each topic.  Handlers get a
+    Message, with the payload decoded by simulacrum.broadcast.decode, so
+    array payloads are views on the received frame, not copies.  Handlers
+    must not write to them.
+    When messages arrive faster than the handlers can keep up, the stale
+    ones are skipped: after a handler returns, only the newest message
+    waiting for each topic is handled.  Topics that send one message per
+    device, like PART_POSITIONS, pass a key function to subscribe, so the
+    newest message for each device is kept.
+    Subclasses can register their handlers in __init__, or services can
+    make a Subscriber and register their methods.  Either way, run the
+    run() coroutine as a task on the event loop.
+    generations has the generation of the newest message handled on each
+    topic, and skipped counts the messages that were skipped.
+    """
+    def __init__(self, address=None, ctx=None):
+        self.address = address or "tcp://127.0.0.1:{}".format(os.environ.get('MODEL_BROADCAST_PORT', 66666))
+        self.socket = (ctx or Context.instance()).socket(zmq.SUB)
+        self.socket.connect(self.address)
+        #topic -> (handler, key function)
+        self.handlers = {}
+        self.generations = {}
+        self.skipped = 0
+
+    def subscribe(self, topic, handler, key=None):
+        """
+        Calls the coroutine function handler(message) for messages on topic.
+        key(message) returns the part of a message that identifies what it
+        is about, if the topic sends separate messages about different
+        things, so newer messages only replace older ones with the same key.
+        """
+        self.handlers[topic] = (handler, key)
+        self.socket.setsockopt(zmq.SUBSCRIBE, topic)
+
+    def unsubscribe(self, topic):
+        del self.handlers[topic]
+        self.socket.setsockopt(zmq.UNSUBSCRIBE, topic)
+
+    async def run(self):
+        while True:
+            latest = OrderedDict()
+            self.receive(await self.socket.recv_multipart(copy=False), latest)
+            #Whatever queued up while the last handlers ran gets collapsed to the newest of each.
+            while True:
+                try:
+                    frames = self.socket.recv_multipart(flags=zmq.NOBLOCK, copy=False).result()
+                except zmq.Again:
+                    break
+                self.receive(frames, latest)
+            for message in latest.values():
+                await self.dispatch(message)
+
+    def receive(self, frames, latest):
+        message = Message(*broadcast.decode(frames))
+        if message.topic not in self.handlers:
+            return
+        _, key = self.handlers[message.topic]
+        k = (message.topic, None if key is None else key(message))
+        if latest.pop(k, None) is not None:
+            self.skipped += 1
+        latest[k] = message
+
+    async def dispatch(self, message):
+        #The handler might have been unsubscribed by another one in this batch.
+        handler, _ = self.handlers.get(message.topic, (None, None))
+        if handler is None:
+            return
+        previous = self.generations.get(message.topic)
+        if previous is not None and message.header.generation < previous:
+            L.info("Generation went from %d to %d on %s, the model service was restarted.", previous, message.header.generation, message.topic)
+        self.generations[message.topic] = message.header.generation
+        try:
+            await handler(message)
+        except Exception:
+            L.exception("Handler for %s failed.", message.topic)
@@ -8,7 +8,6 @@ from collections import OrderedDict
 from caproto.server import ioc_arg_parser, run, pvproperty, PVGroup
 from caproto import ChannelType
 import simulacrum
-import zmq
 from zmq.asyncio import Context
     
 m_electron = 0.5109989461E6 #eV
@@ -173,9 +172,7 @@ class UndulatorService(simulacrum.Service):
     def __init__(self):
         super().__init__()
         self.ctx = Context.instance()
-        #cmd socket is a synchronous socket, we don't want the asyncio context.
-        self.cmd_socket = zmq.Context().socket(zmq.REQ)
-        self.cmd_socket.connect("tcp://127.0.0.1:{}".format(os.environ.get('MODEL_PORT', 12312)))
+        self.model_client = simulacrum.ModelClient()
         init_vals = self.get_initial_values()
         undulator_element_list = self.get_undulator_list_from_model()
         undulator_device_list = [simulacrum.util.convert_element_to_device(element) for element in undulator_element_list]
@@ -202,8 +199,7 @@ class UndulatorService(simulacrum.Service):
 
     def get_undulator_list_from_model(self):
         element_list = []
-        self.cmd_socket.send_pyobj({"cmd": "tao", "val": "show ele -no_slaves Wiggler::*  "})
-        for row in self.cmd_socket.recv_pyobj()['result'][:-1]:
+        for row in self.model_client.tao_sync("show ele -no_slaves Wiggler::*  ")[:-1]:
             element_list.append(row.split(None, 3)[1])
         return element_list
 
@@ -226,9 +222,8 @@ class UndulatorService(simulacrum.Service):
     def get_undulator_Kacts_from_model(self):
         init_vals = {}
         for (attr, dev_list, parse_func) in [("B_MAX", "UMA*", _parse_undulator_table), ("B_MAX", "PS*", _parse_undulator_table)]:
-            self.cmd_socket.send_pyobj({"cmd": "tao", "val": "show lat -no_label_lines -attribute {attr} {list}".format(attr=attr, list=dev_list)})
-#        self.cmd_socket.send_pyobj({"cmd": "tao", "val": "show lat -no_label_lines -no_slaves -attribute {attr} {list}".format(attr="B_MAX", list="UMAHX*")})
-            table = self.cmd_socket.recv_pyobj()
+            table = self.model_client.request_sync({"cmd": "tao", "val": "show lat -no_label_lines -attribute {attr} {list}".format(attr=attr, list=dev_list)})
+#            table = self.model_client.request_sync({"cmd": "tao", "val": "show lat -no_label_lines -no_slaves -attribute {attr} {list}".format(attr="B_MAX", list="UMAHX*")})
             init_vals.update(_parse_undulator_table(table['result']))
         return init_vals
 
@@ -238,24 +233,22 @@ class UndulatorService(simulacrum.Service):
         conv = self.conversion_to_BMAD_for_und_type[und_type]
         #l = magnet_pv.length
         L.debug('Updating {}... '.format( undulator_pv.device_name ) )
-        self.cmd_socket.send_pyobj({"cmd": "tao", "val": "set ele {element} {attr} = {val}".format(element=undulator_pv.element_name, 
-                                                                                                   attr=und_attr,
-                                                                                                   val=conv(valueK))})
-        self.cmd_socket.recv_pyobj()
         #Update BPM offsets when K changes see gapFromK.py
         gap =  get_undulator_gap_from_K(undulator_pv.element_name, valueK)
         bpm_yOffset = get_bpm_offset_form_gap(gap)
         bpm_element = get_bpm_element_from_useg(undulator_pv.element_name)
-        self.cmd_socket.send_pyobj({"cmd": "tao", "val": "set ele {element} y_offset = {val}".format(element=bpm_element,  val=bpm_yOffset)})
-        self.cmd_socket.recv_pyobj()
+        #Both commands go to the model in one batch.
+        await asyncio.gather(self.model_client.request({"cmd": "tao", "val": "set ele {element} {attr} = {val}".format(element=undulator_pv.element_name,
+                                                                                                                      attr=und_attr,
+                                                                                                                      val=conv(valueK))}),
+                             self.model_client.request({"cmd": "tao", "val": "set ele {element} y_offset = {val}".format(element=bpm_element,  val=bpm_yOffset)}))
 
         L.info('Updated {}.'.format(undulator_pv.device_name))
 
     async def on_heater_und_change(self, undulator_pv, value):
         b_max = Kact_to_heater_b_max(value)
         L.debug('Updating {}... '.format( undulator_pv.device_name ) )
-        self.cmd_socket.send_pyobj({"cmd": "tao", "val": "set ele LH_UND B_MAX = {bmax}".format(bmax=b_max)})
-        self.cmd_socket.recv_pyobj()
+        await self.model_client.request({"cmd": "tao", "val": "set ele LH_UND B_MAX = {bmax}".format(bmax=b_max)})
         L.info('Updated {}.'.format(undulator_pv.device_name))
 
 